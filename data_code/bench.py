@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import numpy as np
+import zarr
+from datetime import datetime, timedelta
+from utils import datdir, cachedir
+from utils import s3_utils, cache_utils, screen_utils, model_utils, regrid_utils
+from utils.s3_utils import use_local, s3_client, find_key, listings
+from utils.metrics_utils import take, track_subprocesses
+from utils.screen_utils import cref_hour
+from utils.model_utils import mrms_keys, goes_keys, hrrr_fetch, mrms, hrrr, goes
+from utils.helper_utils import create_dir, elev_time, merge_ins, locate_data, check_inst, make_target
+
+# stages in pipeline order, each timed on its own
+stages = ['locate_data', 'check_inst', 'mrms', 'hrrr', 'goes', 'elev_time', 'merge_ins', 'make_target']
+delaytimes = [3, 55, 5]
+template = {'gridtype': 'lonlat', 'xsize': 250, 'ysize': 250, 'xinc': 0.02, 'yinc': 0.02}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--time', required=True, help='sample time, YYYYmmdd_HHMM')
+    parser.add_argument('--root', type=str, default=os.path.join('..', 'bench', 's3'), help='replay directory, laid out as <bucket>/<key>')
+    parser.add_argument('--record', action='store_true', help='copy the objects the stages read from the live buckets into --root, then exit')
+    parser.add_argument('--xfirst', type=float, default=-98.0)
+    parser.add_argument('--yfirst', type=float, default=33.0)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage; the median is reported')
+    parser.add_argument('--warm', action='store_true', help='keep the frame and listing caches between runs instead of starting each run cold')
+    parser.add_argument('--baseline', type=str, default=None, help='npz of outputs to compare against')
+    parser.add_argument('--save_baseline', action='store_true', help='write this run\'s outputs to --baseline instead of comparing')
+    parser.add_argument('--out', type=str, default='../data_info/bench.jsonl')
+    return parser.parse_args()
+
+
+def _rss():
+    with open('/proc/self/status') as file:
+        for line in file:
+            if line.startswith('VmRSS:'): return int(line.split()[1]) * 1024
+    return 0
+
+
+class Peak:
+    # samples this process's RSS while a stage runs; ru_maxrss only ever reports the high-water mark of the whole run
+    def __init__(self, every=0.005):
+        self.every = every
+        self.peak = 0
+        self.stop = threading.Event()
+
+    def watch(self):
+        while not self.stop.wait(self.every): self.peak = max(self.peak, _rss())
+
+    def __enter__(self):
+        self.peak = _rss()
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        self.peak = max(self.peak, _rss())
+
+
+def record(stamp, root, grid):
+    # every object a replay of this timestamp reads, plus the decoded HRRR cycles, which Herbie fetches outside boto3
+    use_local(None)
+    def copy(bucket, key):
+        path = os.path.join(root, bucket, key)
+        if os.path.exists(path) or key is None: return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        s3_client().download_file(bucket, key, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+        print(f"Recorded {bucket}/{key}")
+    locate_data(stamp, "Reflectivity_-10C_00.50", delaytimes)
+    for (bucket, prefix), keys in listings().items():
+        if keys: copy(bucket, keys[0])
+    hour = cref_hour(stamp)
+    copy("noaa-mrms-pds", find_key("noaa-mrms-pds", f"CONUS/CREF_1HR_MAX_00.50/{hour:%Y%m%d}/", hour))
+    for tstamp, key in mrms_keys("Reflectivity_-10C_00.50", stamp, delaytimes): copy("noaa-mrms-pds", key)
+    for tstamp, key in goes_keys(stamp, delaytimes)[0]: copy("noaa-goes16", key)
+    hrtime, frames = hrrr_fetch(stamp, 2, delaytimes)
+    os.makedirs(os.path.join(root, 'hrrr'), exist_ok=True)
+    for cycle in [hrtime, hrtime + timedelta(hours=1)]:
+        for path in glob.glob(os.path.join(model_utils.hrrrdir, f"{cycle:%Y%m%d%H}_*.npz")): shutil.copy(path, os.path.join(root, 'hrrr'))
+    shutil.copy(os.path.join(model_utils.hrrrdir, 'grid.npz'), os.path.join(root, 'hrrr'))
+
+
+def replay(root, scratch):
+    # every cache the stages consult points into scratch, and HRRR cycles come from the recording
+    use_local(root)
+    cache_utils.framedir = os.path.join(scratch, 'frames')
+    screen_utils.screendir = os.path.join(scratch, 'cref')
+    s3_utils.idxdir = os.path.join(scratch, 's3index')
+    regrid_utils.regriddir = os.path.join(scratch, 'regrid')
+    model_utils.hrrrdir = os.path.join(root, 'hrrr')
+    screen_utils._summaries.clear()
+    model_utils._cycles.clear()
+    regrid_utils.reset_lattices()
+
+
+def run_stages(stamp, name, grid):
+    grids = [(name, grid)]
+    ysize, xsize = grid['ysize'], grid['xsize']
+    return [
+        ('locate_data', lambda: locate_data(stamp, "Reflectivity_-10C_00.50", delaytimes)),
+        ('check_inst', lambda: check_inst(stamp, 40, 40, grid)),
+        ('mrms', lambda: mrms(name, "Reflectivity_-10C_00.50", "rf-10", stamp, delaytimes, ysize, xsize, grids=grids)),
+        ('hrrr', lambda: hrrr(name, stamp, 2, delaytimes, grids=grids)),
+        ('goes', lambda: goes(name, stamp, delaytimes, grids=grids)),
+        ('elev_time', lambda: elev_time(stamp, grid).load()),
+        ('merge_ins', lambda: merge_ins(name, ysize, xsize, stamp, grid)),
+        ('make_target', lambda: make_target(name, 35, 100, -50, 3)),
+    ]
+
+
+def measure(func):
+    client = s3_client()
+    calls, got = client.calls, client.bytes
+    take()
+    error = None
+    with Peak() as peak:
+        start = time.perf_counter()
+        try: func()
+        except Exception as e: error = f"{type(e).__name__}: {e}"
+        seconds = time.perf_counter() - start
+    launches = sum(counter['value'] for counter in take() if counter['name'] == 'subprocess_launches')
+    return {'error': error, 'seconds': seconds, 'peak_rss_mb': peak.peak / 1024**2, 'subprocesses': launches, 's3_calls': client.calls - calls, 's3_mb': (client.bytes - got) / 1024**2}
+
+
+def outputs(name):
+    # every data variable of the sample's three stores, keyed prod/var
+    arrays = {}
+    for prod in ['mrms', 'inputs', 'target']:
+        path = f"../{datdir}/{name}/{prod}.zarr"
+        if not os.path.exists(path): continue
+        group = zarr.open_group(path, mode='r')
+        for var, arr in group.arrays():
+            if var in ['time', 'lat', 'lon']: continue
+            arrays[f"{prod}/{var}"] = np.asarray(arr[...])
+    return arrays
+
+
+def compare(found, baseline):
+    with np.load(baseline) as saved: expected = {key: saved[key] for key in saved.files}
+    report = {'missing': sorted(set(expected) - set(found)), 'extra': sorted(set(found) - set(expected)), 'differ': {}}
+    for key in sorted(set(found) & set(expected)):
+        a, b = found[key], expected[key]
+        if a.shape != b.shape: report['differ'][key] = f"shape {a.shape} != {b.shape}"
+        elif not np.allclose(a, b, rtol=1e-5, atol=1e-6, equal_nan=True):
+            report['differ'][key] = f"max abs diff {float(np.nanmax(np.abs(a.astype(np.float64) - b))):.6g}"
+    report['equivalent'] = not (report['missing'] or report['differ'])
+    return report
+
+
+def main():
+    args = parse_args()
+    track_subprocesses()
+    stamp = datetime.strptime(args.time, "%Y%m%d_%H%M")
+    grid = dict(template, xfirst=args.xfirst, yfirst=args.yfirst)
+    os.makedirs("../data_info", exist_ok=True)
+    if args.record: return record(stamp, args.root, grid)
+
+    name = f"bench_{args.time}"
+    runs = {stage: [] for stage in stages}
+    os.makedirs(os.path.join('..', cachedir), exist_ok=True)
+    scratch = tempfile.mkdtemp(prefix='bench_', dir=os.path.join('..', cachedir))
+    try:
+        for r in range(max(1, args.repeat)):
+            if not args.warm or r == 0:
+                shutil.rmtree(scratch, ignore_errors=True)
+                replay(args.root, scratch)
+            create_dir(name)
+            for stage, func in run_stages(stamp, name, grid):
+                runs[stage].append(measure(func))
+                print(f"run {r+1} {stage}: {runs[stage][-1]['seconds']:.3f} s" + (f" ({runs[stage][-1]['error']})" if runs[stage][-1]['error'] else ""))
+        found = outputs(name)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+        shutil.rmtree(f"../{datdir}/{name}", ignore_errors=True)
+
+    report = {'time': args.time, 'grid': grid, 'repeat': args.repeat, 'warm': args.warm, 'stages': {}}
+    for stage in stages:
+        found_runs = runs[stage]
+        report['stages'][stage] = {key: float(np.median([run[key] for run in found_runs])) for key in found_runs[0] if key != 'error'}
+        report['stages'][stage]['runs'] = [run['seconds'] for run in found_runs]
+        report['stages'][stage]['errors'] = [run['error'] for run in found_runs if run['error']]
+    total = sum(report['stages'][stage]['seconds'] for stage in stages)
+    report['total_seconds'] = total
+    report['samples_per_hour'] = 3600 / total if total else None
+    report['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    report['children_max_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    if args.baseline and args.save_baseline:
+        np.savez_compressed(args.baseline, **found)
+        print(f"Saved {len(found)} arrays to {args.baseline}")
+    elif args.baseline: report['equivalence'] = compare(found, args.baseline)
+    with open(args.out, "a") as file: file.write(json.dumps(report) + "\n")
+
+    print("")
+    print(f"{'stage':<12}{'seconds':>10}{'peak MB':>10}{'procs':>7}{'S3 calls':>10}{'S3 MB':>9}")
+    for stage in stages:
+        found_stage = report['stages'][stage]
+        print(f"{stage:<12}{found_stage['seconds']:>10.3f}{found_stage['peak_rss_mb']:>10.1f}{found_stage['subprocesses']:>7.0f}{found_stage['s3_calls']:>10.0f}{found_stage['s3_mb']:>9.1f}")
+    print(f"{'total':<12}{total:>10.3f}   ({report['samples_per_hour']:.1f} samples/hour)")
+    for stage in stages:
+        if report['stages'][stage]['errors']: print(f"{stage} failed in {len(report['stages'][stage]['errors'])} run(s): {report['stages'][stage]['errors'][0]}")
+    if 'equivalence' in report:
+        eq = report['equivalence']
+        print("Outputs match the baseline" if eq['equivalent'] else f"Outputs differ from the baseline: {eq}")
+
+if __name__ == "__main__":
+    main()
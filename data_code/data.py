@@ -2,15 +2,76 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import json
 import time
 import random
 import shutil
-import multiprocessing
 import numpy as np
 from datetime import datetime, timedelta
 from utils import datdir
-from utils.model_utils import hrrr, mrms, goes
-from utils.helper_utils import parse_args, create_dir, elev_time, merge_ins, locate_data, process_data, check_inst, make_target
+from utils.model_utils import hrrr, mrms, goes, prefetch_mrms, prefetch_hrrr, prefetch_goes
+from utils.regrid_utils import grid_text, tile_grids
+from utils.screen_utils import cref_summary, draw_grids
+from utils.sched_utils import Scheduler
+from utils.metrics_utils import Metrics, track_subprocesses
+from utils.store_utils import append_samples
+from utils.manifest_utils import manifest_path, open_manifest, record_group, group_samples, mark_task, done_tasks, mark_sample, sample_checksums, record_checksums
+from utils.helper_utils import parse_args, create_dir, merge_ins, locate_data, process_data, check_insts, make_target
+
+
+def process_all(dirnames, remove):
+    for dirname in dirnames: process_data(dirname, remove)
+
+
+def target_all(dirnames, ref, cape, cin, tch):
+    # the checksums go back to the scheduler with the result, so it never reads the stores itself
+    for dirname in dirnames: make_target(dirname, ref, cape, cin, tch)
+    return {dirname: sample_checksums(dirname) for dirname in dirnames}
+
+
+def merge_all(samples, etime, ygrd, xgrd):
+    for dirname, grid in samples: merge_ins(dirname, ygrd, xgrd, etime, grid)
+
+
+def have(dirnames, path):
+    return lambda: all(os.path.exists(f"../{datdir}/{dirname}/{path}") for dirname in dirnames)
+
+
+def record_tiles(name, datetime_cr, samples, tiles, stride):
+    # where each tile of a timestamp sits, so a tiled run can be stitched back together
+    os.makedirs(f"../{datdir}/tiles", exist_ok=True)
+    layout = {'time': datetime_cr.strftime("%Y-%m-%d %H:%M"), 'stride': stride, 'tiles': [dict(grid, name=sample, row=r, col=c) for (sample, grid), (r, c, tile) in zip(samples, tiles)]}
+    with open(f"../{datdir}/tiles/{name}.json", "w") as file: json.dump(layout, file, indent=1)
+
+
+def add_sample(sched, name, datetime_cr, samples, delaytimes, ysize, xsize, rule, finish, skip=(), clean=True, shards=None, hthds=2, parts=1):
+    # fetch -> decode/regrid -> merge -> validate -> target for one timestamp and all of its windows
+    # tasks the manifest already has as done are left out, and their dependents treat them as met
+    dirNames = [sample[0] for sample in samples]
+    for sample in dirNames: create_dir(sample, clean=clean)
+    first = dirNames[0]
+    add = lambda task, *rest, **kw: task if task in skip else sched.add(task, *rest, **kw)
+    f_rf10 = add(f"{name}/fetch_rf-10", 'fetch', prefetch_mrms, ("Reflectivity_-10C_00.50", datetime_cr, delaytimes, ))
+    f_hrrr = add(f"{name}/fetch_hrrr", 'fetch', prefetch_hrrr, (datetime_cr, hthds, delaytimes, ))
+    f_goes = add(f"{name}/fetch_goes", 'fetch', prefetch_goes, (datetime_cr, delaytimes, ))
+    tfm_rf10 = add(f"{name}/rf-10", 'decode', mrms, (first, "Reflectivity_-10C_00.50", "rf-10", datetime_cr, delaytimes, ysize, xsize, ), {'grids': samples}, deps=[f_rf10], check=have(dirNames, "mrms.zarr/"))
+    tfm_hrrr = add(f"{name}/hrrr", 'decode', hrrr, (first, datetime_cr, hthds, delaytimes, ), {'grids': samples}, deps=[f_hrrr], check=have(dirNames, "backup/hrrr.nc"))
+    tfm_goes = add(f"{name}/goes", 'decode', goes, (first, datetime_cr, delaytimes, ), {'grids': samples}, deps=[f_goes], check=have(dirNames, "backup/goes.nc"))
+    # elevation is sliced from its lattice copy inside merge, so it has no task of its own
+    # the per-window stages are split into parts, so a large tile set spreads over the pool; each part finishes on its own
+    size = -(-len(samples) // max(1, parts))
+    for k in range(0, len(samples), size):
+        part = samples[k:k+size]
+        names = [sample[0] for sample in part]
+        tag = "" if size >= len(samples) else f"_{k // size}"
+        done = lambda part=part: finish(part)
+        mrge_file = add(f"{name}/merge{tag}", 'merge', merge_all, (part, datetime_cr, ysize, xsize, ), deps=[tfm_hrrr, tfm_goes], check=have(names, "inputs.zarr/"))
+        check = add(f"{name}/validate{tag}", 'validate', process_all, (names, True, ), deps=[mrge_file, tfm_rf10])
+        last = add(f"{name}/target{tag}", 'target', target_all, (names, ) + rule, deps=[check], after=done if shards is None else None)
+        # with a consolidated store the samples are appended last and their per-sample stores dropped
+        if shards is not None: last = add(f"{name}/store{tag}", 'store', append_samples, (names, shards, True, ), deps=[last], after=done)
+        if last in skip: done()
 
 
 def main():
@@ -20,10 +81,18 @@ def main():
     args = parse_args()
     tout = 500
     total_att = 6
-    try: shutil.rmtree("../data_info")
-    except: pass
+    limits = {}
+    for limit in args.limits.split(','):
+        if '=' in limit: limits[limit.split('=')[0]] = int(limit.split('=')[1])
+    if args.fresh:
+        try: shutil.rmtree("../data_info")
+        except: pass
+        try: os.remove(manifest_path)
+        except: pass
     os.makedirs("../data_info", exist_ok=True)
-    os.environ["REMAP_EXTRAPOLATE"] = "off"
+    db = open_manifest()
+    random.seed(args.seed)
+    np.random.seed(args.seed)
     # mrms, hrrr, goes
     delaytimes = [3, 55, 5]
     ref = 35
@@ -40,8 +109,34 @@ def main():
     stdate_gb = datetime.strptime(args.start,"%Y%m%d")
     eddate_gb = datetime.strptime(args.end,"%Y%m%d")
     step_gb = timedelta(days=1)
-    files_done = 0
-    prev_dirname = "20000101_0000_1"
+    files_done = [0]
+    bsz = max(1, args.batch)
+    shards = max(1, args.shards) if args.store else None
+    track_subprocesses()
+    metrics = Metrics()
+    def done(task):
+        mark_task(db, task.name, task.stage, 'done', task.tries)
+        if task.stage == 'target' and task.result: record_checksums(db, task.result)
+    sched = Scheduler(args.workers, limits=limits, retries=total_att-1, timeout=tout, log="../data_info/retries.txt", on_done=done, metrics=metrics)
+    
+    def finished(lst):
+        def finish(samples):
+            lti = round(time.time()-lst, 3)
+            for sample, grid in samples:
+                if not args.backup: shutil.rmtree(f"../{datdir}/{sample}/backup/", ignore_errors=True)
+                timing = f"{sample} done in {lti} seconds\n"
+                with open("../data_info/timings.txt", "a") as file: file.write(timing)
+                print("\n" + timing)
+                if os.path.isdir(f"../{datdir}/{sample}"):
+                    with open(f"../{datdir}/{sample}/grid.txt", "w") as file: file.write(grid_text(grid))
+                mark_sample(db, sample, 'done')
+            files_done[0] += len(samples)
+        return finish
+    template = {'gridtype': gridtype, 'xsize': xsize, 'ysize': ysize, 'xinc': xinc, 'yinc': yinc}
+    tiles = tile_grids(template, args.stride) if args.tiles else []
+    parts = args.workers if args.tiles else 1
+    # a tiled timestamp counts once against --grids however many tiles it has
+    counted = (lambda samples: 1) if args.tiles else len
     
     # loop through days
     for i in range((eddate_gb - stdate_gb).days +1):
@@ -56,18 +151,6 @@ def main():
             # loop through selections per time section
             while g < gps:
                 z = 0
-                # choose a random geographical area
-                xfirst = round(random.uniform(-116.1, -76.1), 2)
-                yfirst = round(random.uniform(25, 45), 2)
-                grid_specs = f"""gridtype = {gridtype}
-                xsize    = {xsize}
-                ysize    = {ysize}
-                xfirst   = {xfirst}
-                xinc     = {xinc}
-                yfirst   = {yfirst}
-                yinc     = {yinc}
-                """
-                with open("./mygrid", "w") as file: file.write(grid_specs)
                 # get a time that hasn't already been taken
                 while z == 0:
                     hour_cr = np.random.randint(s*(24/fpd), (s*(24/fpd))+(24/fpd))
@@ -75,59 +158,48 @@ def main():
                     datetime_cr = date_cr + timedelta(hours=hour_cr, minutes=minute_cr)
                     dirName = datetime_cr.strftime("%Y%m%d_%H%M")
                     if dirName not in fnames: z = 1
+                # choose random geographical areas, all cut from the same downloads
+                grids = [grid for r, c, grid in tiles]
+                if args.screened and not args.tiles:
+                    try: grids = draw_grids(cref_summary(datetime_cr, 40), bsz, 40, template)
+                    except: grids = []
+                while not args.tiles and len(grids) < bsz:
+                    xfirst = round(random.uniform(-116.1, -76.1), 2)
+                    yfirst = round(random.uniform(25, 45), 2)
+                    grids.append(dict(template, xfirst=xfirst, yfirst=yfirst))
+                # samples the manifest already knows are resumed (or skipped) instead of drawn again
+                recorded = group_samples(db, dirName)
+                if recorded is not None:
+                    samples, complete = recorded
+                    fnames.add(dirName)
+                    if complete: print("\n" + f"{dirName} already complete\n")
+                    else:
+                        print("\n" + f"Resuming {dirName}\n")
+                        add_sample(sched, dirName, datetime_cr, samples, delaytimes, ysize, xsize, (ref, cape, cin, tch, ), finished(time.time()), skip=done_tasks(db, dirName), clean=False, shards=shards, hthds=args.hrrr_threads, parts=parts)
+                    g += counted(samples)
+                    continue
                 # check if it exists
                 if locate_data(datetime_cr, "Reflectivity_-10C_00.50", delaytimes) == 1:
-                    # check if it has potential to have hits in the target
-                    if check_inst(dirName, datetime_cr, 40, 40) == 1:
+                    # check which areas have potential to have hits in the target; a tiled timestamp keeps every tile
+                    flags = [1] * len(grids) if args.tiles else check_insts(datetime_cr, 40, 40, grids)
+                    if any(flags):
                         lst = time.time()
+                        if args.tiles:
+                            samples = [(f"{dirName}_{r:02d}_{c:02d}", grid) for r, c, grid in tiles]
+                            record_tiles(dirName, datetime_cr, samples, tiles, args.stride)
+                        else:
+                            samples = [(dirName if bsz == 1 else f"{dirName}_{k}", grid) for k, grid in enumerate(grids) if flags[k] == 1]
+                            samples = samples[:gps-g]
                         # add it to the set of times retrieved for this time section
                         fnames.add(dirName)
-                        print("\n" + datetime_cr.strftime("%Y-%m-%d %H:%M") + " has been found\n")
-                        check = multiprocessing.Process(target=process_data, args=(prev_dirname, True, ))
-                        target = multiprocessing.Process(target=make_target, args=(prev_dirname, ref, cape, cin, tch, ))
-                        if files_done > 0: check.start()
-                        attempt = 1
-                        while attempt <= total_att:
-                            create_dir(dirName)
-                            tfm_rf10 = multiprocessing.Process(target=mrms, args=(dirName, "Reflectivity_-10C_00.50", "rf-10", datetime_cr, delaytimes, ysize, xsize, ))
-                            tfm_hrrr = multiprocessing.Process(target=hrrr, args=(dirName, datetime_cr, 1, delaytimes, ))
-                            tfm_goes = multiprocessing.Process(target=goes, args=(dirName, datetime_cr, delaytimes, ))
-                            tfm_elev = multiprocessing.Process(target=elev_time, args=(dirName, datetime_cr, ))
-                            mrge_file = multiprocessing.Process(target=merge_ins, args=(dirName, ysize, xsize, ))
-                            tfm_goes.start()
-                            tfm_rf10.start()
-                            tfm_hrrr.start()
-                            tfm_elev.start()
-                            if files_done > 0:
-                                check.join(tout)
-                                target.start()
-                            tfm_elev.join(tout)
-                            tfm_hrrr.join(tout)
-                            tfm_goes.join(tout)
-                            mrge_file.start()
-                            mrge_file.join(tout)
-                            if files_done > 0: target.join(tout)
-                            tfm_rf10.join(tout)
-                            if not (os.path.exists(f"../{datdir}/{dirName}/inputs.zarr/") and os.path.exists(f"../{datdir}/{dirName}/mrms.zarr/")):
-                                if attempt != total_att:
-                                    shutil.rmtree(f"../{datdir}/{dirName}/")
-                                    err = f"{dirName} retry #{attempt} (attempt #{attempt+1})"
-                                    print("\n\n" + err + "\n\n")
-                                    with open("../data_info/retries.txt", "a") as file: file.write(err + "\n")
-                                attempt += 1
-                                time.sleep(1)
-                            else: attempt = total_att + 1
-                        if not args.backup: shutil.rmtree(f"../{datdir}/{dirName}/backup/")
-                        let = time.time()
-                        lti = round(let-lst, 3)
-                        timing = f"{dirName} done in {lti} seconds\n"
-                        with open("../data_info/timings.txt", "a") as file: file.write(timing)
-                        print("\n" + timing)
-                        shutil.copy("./mygrid", f"../{datdir}/{dirName}/grid.txt")
-                        prev_dirname = dirName
+                        print("\n" + datetime_cr.strftime("%Y-%m-%d %H:%M") + f" has been found ({len(samples)} grids)\n")
+                        record_group(db, dirName, datetime_cr, samples)
+                        add_sample(sched, dirName, datetime_cr, samples, delaytimes, ysize, xsize, (ref, cape, cin, tch, ), finished(lst), shards=shards, hthds=args.hrrr_threads, parts=parts)
+                        # keep the sampler only a few timestamps ahead of the workers
+                        sched.pump()
+                        while sched.pending() > 18 * args.workers: sched.pump(block=True)
                         atts = 0
-                        files_done += 1
-                        g+=1
+                        g += counted(samples)
                     
                     else:
                         atts+=1
@@ -140,13 +212,20 @@ def main():
                     print("\n" + datetime_cr.strftime("%Y-%m-%d %H:%M") + " does not exist\n")
                     g+=1
 
+    sched.drain()
+    sched.close()
+    metrics.flush()
+    files_done = files_done[0]
     if files_done > 0:
-        process_data(prev_dirname, True)
-        make_target(prev_dirname, ref, cape, cin, tch)
+        # a resumed run appends to the previous run's file: keep one header and the latest line per sample
+        latest = {}
         with open("../data_info/instances.txt", "r") as file:
-            lines = file.readlines()
-            lines = sorted(lines)
-            lines.insert(0, f"Rule: At least {ref} dBz reflectivity and {cape} j/kg of MUCAPE and at most {cin} j/kg of MUCIN and touching at least {tch} other point(s)\n")
+            for line in file:
+                if line.startswith("Rule:") or not line.strip(): continue
+                found = re.match(r"(?:Instances of convective initiation in|Error in) (\S+):", line)
+                latest[found.group(1) if found else line] = line
+        lines = sorted(latest.values())
+        lines.insert(0, f"Rule: At least {ref} dBz reflectivity and {cape} j/kg of MUCAPE and at most {cin} j/kg of MUCIN and touching at least {tch} other point(s)\n")
         with open("../data_info/instances.txt", "w") as file:
             file.writelines(lines)
     et = time.time()
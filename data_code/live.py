@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import argparse
+from datetime import datetime, timedelta, timezone
+from utils import datdir
+from utils.regrid_utils import grid_text
+from utils.stream_utils import Stream, floor_time
+from utils.time_utils import chunk_encoding
+from utils.metrics_utils import Metrics
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--xfirst', type=float, nargs='+', required=True, help='window origins, paired with --yfirst')
+    parser.add_argument('--yfirst', type=float, nargs='+', required=True)
+    parser.add_argument('--poll', type=float, default=30, help='Seconds between bucket polls')
+    parser.add_argument('--start', type=str, default=None, help='replay from YYYYmmdd_HHMM instead of following the wall clock')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay clock rate relative to real time')
+    parser.add_argument('--cycles', type=int, default=0, help='stop after this many cycles (default: run until stopped)')
+    parser.add_argument('--lag', type=int, default=30, help='Minutes a cycle may wait on a late product before it is skipped')
+    return parser.parse_args()
+
+
+def write(ds, path):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    ds.to_zarr(tmp, mode='w', encoding=chunk_encoding(ds, {'time': 1}), consolidated=True)
+    if os.path.exists(path): os.rename(path, f"{tmp}.old")
+    os.rename(tmp, path)
+    if os.path.exists(f"{tmp}.old"): shutil.rmtree(f"{tmp}.old", ignore_errors=True)
+
+
+def main():
+    args = parse_args()
+    os.makedirs("../data_info", exist_ok=True)
+    template = {'gridtype': 'lonlat', 'xsize': 250, 'ysize': 250, 'xinc': 0.02, 'yinc': 0.02}
+    grids = [dict(template, xfirst=x, yfirst=y) for x, y in zip(args.xfirst, args.yfirst)]
+    names = [f"w{k}" for k in range(len(grids))]
+    stream = Stream(list(zip(names, grids)))
+    metrics = Metrics(path=None, prom='../data_info/live.prom')
+    t0 = time.time()
+    start = datetime.strptime(args.start, "%Y%m%d_%H%M") if args.start else None
+    clock = (lambda: start + timedelta(seconds=(time.time() - t0) * args.speed)) if start else (lambda: datetime.now(timezone.utc).replace(tzinfo=None))
+    cycle = floor_time(clock())
+    waiting = []
+    emitted = 0
+
+    while not args.cycles or emitted < args.cycles:
+        now = clock()
+        polled = time.perf_counter()
+        found = stream.poll(now)
+        # every due cycle whose products are all in the rings goes out; a cycle stuck past --lag is given up on
+        while cycle <= now:
+            out = stream.inputs(cycle)
+            if out is None:
+                if now - cycle <= timedelta(minutes=args.lag): break
+                print(f"{cycle:%Y-%m-%d %H:%M} skipped, products still missing")
+                with open("../data_info/warnings.txt", "a") as file: file.write(f"live {cycle:%Y%m%d_%H%M} skipped, products still missing" + "\n")
+            else:
+                for name, grid in zip(names, grids):
+                    base = f"../{datdir}/live/{cycle:%Y%m%d_%H%M}_{name}"
+                    os.makedirs(base, exist_ok=True)
+                    write(out[name], f"{base}/inputs.zarr")
+                    with open(f"{base}/grid.txt", "w") as file: file.write(grid_text(grid))
+                waiting.append(cycle)
+                emitted += 1
+                print(f"{cycle:%Y-%m-%d %H:%M} inputs written in {time.perf_counter() - polled:.2f} s (new frames {found})")
+            cycle += timedelta(minutes=5)
+        # the verifying radar for a cycle completes an hour later
+        for done in list(waiting):
+            out = stream.mrms(done)
+            if out is None:
+                if now - done > timedelta(hours=3): waiting.remove(done)
+                continue
+            for name in names: write(out[name], f"../{datdir}/live/{done:%Y%m%d_%H%M}_{name}/mrms.zarr")
+            waiting.remove(done)
+            print(f"{done:%Y-%m-%d %H:%M} verifying radar written")
+        metrics.flush()
+        if not args.cycles or emitted < args.cycles: time.sleep(args.poll / args.speed if start else args.poll)
+
+if __name__ == "__main__":
+    main()
@@ -6,40 +6,38 @@ Created on Wed Jan  3 22:50:00 2024
 @author: atyagi
 """
 
+import os
 import argparse
-import numpy as np
-import xarray as xr
 from utils import datdir
+from utils.check_utils import reportpath, check_samples
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--dir', type=str)
+    parser.add_argument('--dir', type=str, help='sample to check (default: every sample)')
     parser.add_argument('--prod', type=str)
+    parser.add_argument('--num', type=int, default=os.cpu_count(), help='Number of concurrent processes')
+    parser.add_argument('--out', type=str, default=reportpath, help='JSON report path')
     return parser.parse_args()
 
-def check_nan_values(dirname, prods):
-    for prod in prods:
+def print_report(sample):
+    for prod, store in sample['stores'].items():
         print("")
-        print(f"Checking {prod}...")
+        print(f"Checking {sample['sample']} {prod}...")
         print("")
-        ds = xr.open_zarr(f"../{datdir}/{dirname}/{prod}.zarr")
-        for variable in ds.variables:
-            if variable not in ['lon', 'lat', 'time']:
-                for timestep in ds.time:
-                    try:
-                        data = ds[variable].sel(time=timestep).values
-                        nan_indices = np.isnan(data)
-                        if np.any(nan_indices):
-                            print(f"Variable: {variable}, Timestep: {timestep}")
-                            print("NaN values found at indices:", np.where(nan_indices))
-                            print("")
-                    except Exception as e:
-                        print("")
-                        print(f"{variable} contains ERROR: {e}")
-                        print("")
+        for variable, stats in store['vars'].items():
+            if stats['nan']:
+                print(f"Variable: {variable}, {stats['nan']} NaN values")
+                if 'nan_by_time' in stats: print("NaN values per timestep:", stats['nan_by_time'])
+                print("")
+        for error in store['errors']: print(f"ERROR: {error}")
 
 args = parse_args()
 if args.prod: products = [args.prod]
 else: products = ["inputs", "mrms"]
-check_nan_values(args.dir, products)
-print("done")
\ No newline at end of file
+if args.dir: dirs = [args.dir]
+else: dirs = sorted(item for item in os.listdir(f"../{datdir}/") if os.path.isdir(os.path.join(f"../{datdir}/", item)) and item.startswith("20"))
+summary = check_samples(dirs, args.num, products, args.out)
+for sample in summary['reports']:
+    if not sample['ok']: print_report(sample)
+print(f"{summary['samples'] - len(summary['failed'])} of {summary['samples']} samples passed, report in {args.out}")
+print("done")
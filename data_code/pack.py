@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import argparse
+from utils import datdir
+from utils.store_utils import append_samples
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', type=int, default=1, help='Number of consolidated stores samples are spread over')
+    parser.add_argument('--remove', action='store_true', help='remove the per-sample zarr stores once appended')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    allitems = os.listdir(f"../{datdir}/")
+    dirs = [item for item in allitems if os.path.isdir(os.path.join(f"../{datdir}/", item)) and item.startswith("20")]
+    dirs = sorted(dirname for dirname in dirs if os.path.exists(f"../{datdir}/{dirname}/target.zarr"))
+    for dirname in dirs:
+        try:
+            append_samples([dirname], args.shards, args.remove)
+            print(f"Packed {dirname}")
+        except Exception as e:
+            print(f"Error in {dirname}: {e}")
+
+if __name__ == "__main__":
+    main()
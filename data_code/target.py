@@ -4,63 +4,93 @@
 import os
 import shutil
 import argparse
-import multiprocessing
-import numpy as np
+import itertools
+import zarr
 import xarray as xr
 from utils import datdir
-from scipy.ndimage import convolve
+from utils.store_utils import store_paths, store_encoding
+from utils.target_utils import combo_name, batch_sweep, batch_targets, store_sweep
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--remove', action='store_true', help='remove mrms.zarr (not reccomended)')
-    parser.add_argument('--ref', type=int, required=True, help='Reflectivity change threshold (in dBz)')
-    parser.add_argument('--cape', type=int, required=True, help='MUCAPE threshold (positive j/kg)')
-    parser.add_argument('--cin', type=int, required=True, help='MUCIN threshold (negative j/kg)')
-    parser.add_argument('--touch', type=int, required=True, help='Points touching valid point (includes diagonals)')
-    parser.add_argument('--num', type=int, default=4, help='Number of concurrent processes')
+    parser.add_argument('--ref', type=int, nargs='+', required=True, help='Reflectivity change threshold(s) (in dBz); several values sweep every combination')
+    parser.add_argument('--cape', type=int, nargs='+', required=True, help='MUCAPE threshold(s) (positive j/kg); several values sweep every combination')
+    parser.add_argument('--cin', type=int, nargs='+', required=True, help='MUCIN threshold(s) (negative j/kg); several values sweep every combination')
+    parser.add_argument('--touch', type=int, nargs='+', required=True, help='Points touching valid point (includes diagonals); several values sweep every combination')
+    parser.add_argument('--num', type=int, default=4, help='Number of threads loading samples')
+    parser.add_argument('--batch', type=int, default=64, help='Samples computed together in one pass')
+    parser.add_argument('--store', action='store_true', help='Also rewrite the targets in the consolidated stores')
     return parser.parse_args()
 
 
-def process_directory(dirname, args):
-    ref = args.ref
-    cape = args.cape
-    cin = args.cin
-    tch = args.touch + 1
-    try:
-        mrms = xr.open_zarr(f"../{datdir}/{dirname}/mrms.zarr")
-        ins = xr.open_zarr(f"../{datdir}/{dirname}/inputs.zarr")
-        newds = xr.Dataset()
-        tpar = []
-        for i in range(0, 13):
-            iref = mrms["ReflectivityM10C_500mabovemeansealevel"].isel(time=i)
-            mucp = ins["CAPE_255M0mbaboveground"].isel(time=12)
-            mucn = ins["CIN_255M0mbaboveground"].isel(time=12)
-            rffg = xr.where(iref >= ref, 1, 0)
-            cpfg = xr.where(mucp >= cape, 1, 0)
-            cnfg = xr.where(mucn >= cin, 1, 0)
-            targ = xr.where((rffg == 1) & (cpfg == 1) & (cnfg == 1), 1, 0)
-            tpar.append(targ)
-        tpar_concat = xr.concat(tpar, dim='time')
-        tpar_sum = tpar_concat.sum(dim='time')
-        time_coords = mrms["time"].isel(time=0)
-        newds["time"] = time_coords
-        kernel = np.ones((3, 3))
-        target_data = tpar_sum.data
-        convolved = convolve(target_data, kernel, mode='constant', cval=0)
-        newds["target"] = xr.where((tpar_sum >= 1) & (convolved >= tch), 1, 0)
-        instances = newds["target"].sum().compute()
-        print("\n" + f"Instances of convective initiation in {dirname}: {instances.values}" + "\n")
+def write_target(dirname, newds, totals, counted):
+    # a sweep logs every combination; 'target' itself is the first combination
+    counted.add(dirname)
+    names = [name for name in newds.data_vars if name != 'target'] or ['target']
+    for name in names:
+        instances = int(newds[name].sum())
+        label = dirname if name == 'target' else f"{dirname} {name}"
+        totals[name] = totals.get(name, 0) + instances
+        print("\n" + f"Instances of convective initiation in {label}: {instances}" + "\n")
         with open("../data_info/instances.txt", "a") as file:
-            file.write(f"Instances of convective initiation in {dirname}: {instances.values}" + "\n")
-        try:
-            shutil.rmtree(f"../{datdir}/{dirname}/target.zarr/")
-        except Exception as e:
-            print(f"Error removing target.zarr: {e}")
-        newds.to_zarr(f"../{datdir}/{dirname}/target.zarr", mode='w', consolidated=True)
+            file.write(f"Instances of convective initiation in {label}: {instances}" + "\n")
+    try:
+        shutil.rmtree(f"../{datdir}/{dirname}/target.zarr/")
     except Exception as e:
-        with open("../data_info/instances.txt", "a") as file:
-            file.write(f"Error in {dirname}: {e}" + "\n")
+        print(f"Error removing target.zarr: {e}")
+    newds.to_zarr(f"../{datdir}/{dirname}/target.zarr", mode='w', consolidated=True)
+
+
+def sample_targets(dirnames, args, combos):
+    if len(combos) == 1: return batch_targets(dirnames, *combos[0], threads=args.num)
+    targets = batch_sweep(dirnames, combos, threads=args.num)
+    for newds in targets.values(): newds['target'] = newds[combo_name(combos[0])]
+    return targets
+
+
+def process_batch(dirnames, args, combos, totals, counted):
+    # one stacked computation per batch; a batch that fails to load falls back to one sample at a time
+    try: targets = sample_targets(dirnames, args, combos)
+    except Exception as e:
+        if len(dirnames) > 1:
+            for dirname in dirnames: process_batch([dirname], args, combos, totals, counted)
+        else:
+            with open("../data_info/instances.txt", "a") as file:
+                file.write(f"Error in {dirnames[0]}: {e}" + "\n")
+        return
+    for dirname, newds in targets.items(): write_target(dirname, newds, totals, counted)
+
+
+def drop_stale(path, names):
+    group = zarr.open_group(path, mode='a')
+    for name in names: del group[name]
+    zarr.consolidate_metadata(path)
+
+
+def process_stores(args, combos, totals, counted):
+    # every stored target is rewritten, but a sample whose per-sample stores pack.py kept was already counted
+    for path in store_paths():
+        with xr.open_zarr(path) as ds:
+            newds = store_sweep(ds, combos, batch=args.batch)
+            present = set(ds.variables)
+        newds['target'] = newds[combo_name(combos[0])]
+        if len(combos) == 1: newds = newds[['target']]
+        # combinations from an earlier sweep that this one does not cover are dropped, not left beside the new ones
+        stale = sorted(name for name in present if name.startswith('target_') and name not in newds.data_vars)
+        if stale: drop_stale(path, stale)
+        # variables new to the store get its chunking, existing ones keep theirs
+        encoding = {name: enc for name, enc in store_encoding(newds).items() if name not in present}
+        newds.to_zarr(path, mode='a', consolidated=True, encoding=encoding)
+        for name in [name for name in newds.data_vars if name != 'target'] or ['target']:
+            for dirname, instances in zip(newds['sample'].values, newds[name].sum(dim=('y', 'x')).values):
+                if str(dirname) in counted: continue
+                label = dirname if name == 'target' else f"{dirname} {name}"
+                totals[name] = totals.get(name, 0) + int(instances)
+                with open("../data_info/instances.txt", "a") as file:
+                    file.write(f"Instances of convective initiation in {label}: {instances}" + "\n")
+        print("\n" + f"Rewrote targets in {path}" + "\n")
 
 
 def main():
@@ -69,20 +99,30 @@ def main():
     except:
         pass
     args = parse_args()
+    combos = list(itertools.product(args.ref, args.cape, args.cin, args.touch))
     with open("../data_info/instances.txt", "a") as file:
-        file.write(f"Rule: At least {args.ref} dBz reflectivity and {args.cape} j/kg of MUCAPE and at most {args.cin} j/kg of MUCIN and touching at least {args.touch} other point(s)\n")
+        if len(combos) == 1: file.write(f"Rule: At least {args.ref[0]} dBz reflectivity and {args.cape[0]} j/kg of MUCAPE and at most {args.cin[0]} j/kg of MUCIN and touching at least {args.touch[0]} other point(s)\n")
+        else: file.write(f"Rule sweep: {args.ref} dBz reflectivity, {args.cape} j/kg of MUCAPE, {args.cin} j/kg of MUCIN, touching {args.touch} other point(s); target is {combo_name(combos[0])}\n")
     allitems = os.listdir(f"../{datdir}/")
-    dirs = [item for item in allitems if os.path.isdir(os.path.join(f"../{datdir}/", item)) and item.startswith("20")]
+    dirs = [item for item in allitems if os.path.isdir(os.path.join(f"../{datdir}/", item)) and item.startswith("20") and os.path.exists(f"../{datdir}/{item}/mrms.zarr")]
     dirs = sorted(dirs)
     
-    with multiprocessing.Pool(processes=args.num) as pool:
-        pool.starmap(process_directory, [(dirname, args) for dirname in dirs])
+    totals = {}
+    counted = set()
+    for start in range(0, len(dirs), args.batch):
+        process_batch(dirs[start:start+args.batch], args, combos, totals, counted)
+    if args.store: process_stores(args, combos, totals, counted)
     with open("../data_info/instances.txt", "r") as file:
         lines = file.readlines()
         lines = sorted(lines)
         lines.insert(0, lines.pop())
     with open("../data_info/instances.txt", "w") as file:
         file.writelines(lines)
+    if len(combos) > 1:
+        with open("../data_info/sweep.txt", "w") as file:
+            for ref, cape, cin, touch in combos:
+                name = combo_name((ref, cape, cin, touch))
+                file.write(f"{name}: {ref} dBz, {cape} j/kg MUCAPE, {cin} j/kg MUCIN, touching {touch}: {totals.get(name, 0)} instances\n")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import fcntl
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+from . import cachedir
+from utils.metrics_utils import count
+
+# raw objects shared by every worker process, keyed by bucket key
+framedir = os.path.join('..', cachedir, 'frames')
+framecap = 40 * 1024**3
+_written = [0]
+_sweep_lock = threading.Lock()
+
+
+def cache_path(bucket, key):
+    digest = hashlib.sha256(f"{bucket}/{key}".encode()).hexdigest()
+    ext = os.path.basename(key).split('.', 1)[-1] if '.' in os.path.basename(key) else 'bin'
+    return os.path.join(framedir, 'raw', digest[:2], f"{digest}.{ext}")
+
+
+def cache_get(bucket, key):
+    path = cache_path(bucket, key)
+    try: os.utime(path)
+    except FileNotFoundError:
+        count('cache_misses', kind='raw')
+        return None
+    count('cache_hits', kind='raw')
+    return path
+
+
+def cache_place(src, dest):
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+    tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try: os.link(src, tmp)
+    except OSError: shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+    return dest
+
+
+def cache_put(bucket, key, src):
+    path = cache_path(bucket, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cache_place(src, path)
+    _account(os.path.getsize(path))
+    return path
+
+
+def cache_added(path):
+    # files other caches write straight under framedir count toward the same cap
+    _account(os.path.getsize(path))
+
+
+@contextmanager
+def cache_lock(name):
+    os.makedirs(os.path.join(framedir, 'locks'), exist_ok=True)
+    with open(os.path.join(framedir, 'locks', f"{name}.lock"), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try: yield
+        finally: fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _account(size):
+    with _sweep_lock:
+        _written[0] += size
+        if _written[0] < framecap // 20: return
+        _written[0] = 0
+    evict()
+
+
+def evict(cap=None):
+    # least recently used first, mtime is refreshed on every hit
+    if cap is None: cap = framecap
+    entries = []
+    for root, dirs, files in os.walk(framedir):
+        if os.path.basename(root) == 'locks': continue
+        for file in files:
+            if '.tmp' in file: continue
+            path = os.path.join(root, file)
+            try: stat = os.stat(path)
+            except FileNotFoundError: continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= cap: break
+        try: os.remove(path)
+        except FileNotFoundError: pass
+        total -= size
+    return total
+
+
+__all__ = ['cache_path', 'cache_get', 'cache_place', 'cache_put', 'cache_added', 'cache_lock', 'evict']
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import numpy as np
+import zarr
+from concurrent.futures import ProcessPoolExecutor
+from . import datdir
+
+reportpath = '../data_info/validation.json'
+# arrays are read this many chunks along their first axis at a time, so a consolidated store never loads whole
+block_chunks = 64
+
+
+def _dims(arr):
+    if arr.metadata.zarr_format == 2: return tuple(arr.attrs.get('_ARRAY_DIMENSIONS', ()))
+    return tuple(arr.metadata.dimension_names or ())
+
+
+def _coords(group):
+    names = set(group.attrs.get('coordinates', '').split())
+    for name, arr in group.arrays():
+        names.update(arr.attrs.get('coordinates', '').split())
+        if _dims(arr) == (name, ): names.add(name)
+    return names
+
+
+def check_array(arr):
+    # nan count, min, max and chunk presence in one pass over the stored chunks
+    dims = _dims(arr)
+    stats = {'dims': list(dims), 'shape': list(arr.shape), 'dtype': str(arr.dtype), 'chunks': arr.nchunks_initialized, 'expected': arr.nchunks, 'nan': 0, 'min': None, 'max': None}
+    if arr.dtype.kind not in 'iufb': return stats
+    by_first = []
+    step = (arr.chunks[0] if arr.ndim else 1) * block_chunks
+    for start in range(0, arr.shape[0] if arr.ndim else 1, step):
+        block = np.asarray(arr[start:start+step] if arr.ndim else arr[...])
+        if block.dtype.kind == 'f':
+            nans = np.isnan(block)
+            stats['nan'] += int(nans.sum())
+            by_first.extend(nans.reshape(nans.shape[0], -1).sum(axis=1).tolist() if block.ndim > 1 else [])
+            if nans.all(): continue
+            lo, hi = float(np.nanmin(block)), float(np.nanmax(block))
+        elif block.size == 0: continue
+        else: lo, hi = float(block.min()), float(block.max())
+        stats['min'] = lo if stats['min'] is None else min(stats['min'], lo)
+        stats['max'] = hi if stats['max'] is None else max(stats['max'], hi)
+    if stats['nan'] and dims[:1] in [('time', ), ('step', )]: stats['nan_by_time'] = by_first
+    return stats
+
+
+def check_store(path, steps=13):
+    report = {'path': path, 'ok': False, 'vars': {}, 'coords': {}, 'errors': []}
+    try: group = zarr.open_group(path, mode='r')
+    except Exception as e:
+        report['errors'].append(f"cannot open: {type(e).__name__}: {e}")
+        return report
+    coords = _coords(group)
+    for name, arr in group.arrays():
+        try: report['coords' if name in coords else 'vars'][name] = check_array(arr)
+        except Exception as e: report['errors'].append(f"{name}: {type(e).__name__}: {e}")
+    for name, stats in report['vars'].items():
+        if stats['chunks'] < stats['expected']: report['errors'].append(f"{name}: {stats['chunks']} of {stats['expected']} chunks")
+        if stats['nan']: report['errors'].append(f"{name}: {stats['nan']} NaN")
+        if 'time' in stats['dims'] and stats['shape'][stats['dims'].index('time')] != steps: report['errors'].append(f"{name}: {stats['shape'][stats['dims'].index('time')]} time steps")
+    if not report['vars']: report['errors'].append("no variables")
+    report['ok'] = not report['errors']
+    return report
+
+
+def check_sample(dirname, prods=('inputs', 'mrms')):
+    stores = {prod: check_store(f"../{datdir}/{dirname}/{prod}.zarr") for prod in prods}
+    return {'sample': dirname, 'ok': all(store['ok'] for store in stores.values()), 'stores': stores}
+
+
+def check_samples(dirnames, workers=os.cpu_count(), prods=('inputs', 'mrms'), report=reportpath):
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        found = list(pool.map(check_sample, dirnames, [prods] * len(dirnames), chunksize=8))
+    summary = {'samples': len(found), 'failed': [sample['sample'] for sample in found if not sample['ok']], 'reports': found}
+    if report is not None:
+        os.makedirs(os.path.dirname(report), exist_ok=True)
+        with open(f"{report}.tmp", 'w') as file: json.dump(summary, file, indent=1)
+        os.replace(f"{report}.tmp", report)
+    return summary
+
+
+__all__ = ['reportpath', 'block_chunks', 'check_array', 'check_store', 'check_sample', 'check_samples']
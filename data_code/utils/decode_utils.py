@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import gzip
+import numpy as np
+import xarray as xr
+import eccodes
+from datetime import datetime
+
+# same variable names wgrib2 -netcdf gives, so nothing downstream changes
+mrms_names = {
+    'Reflectivity_-10C_00.50': 'ReflectivityM10C_500mabovemeansealevel',
+    'CREF_1HR_MAX_00.50': 'ReflectivityCompositeHourlyMax_500mabovemeansealevel',
+}
+hrrr_names = {
+    (0, 1, 3): 'PWAT',
+    (0, 2, 8): 'VVEL',
+    (0, 7, 6): 'CAPE',
+    (0, 7, 7): 'CIN',
+    (0, 3, 5): 'HGT',
+}
+_lat_attrs = {'units': 'degrees_north', 'long_name': 'latitude'}
+_lon_attrs = {'units': 'degrees_east', 'long_name': 'longitude'}
+
+
+def split_messages(buf):
+    # a GRIB2 file is back-to-back messages, each carrying its total length in section 0
+    messages = []
+    start = buf.find(b'GRIB')
+    while start != -1 and start + 16 <= len(buf):
+        length = int.from_bytes(buf[start+8:start+16], 'big')
+        messages.append(buf[start:start+length])
+        start = buf.find(b'GRIB', start + length)
+    return messages
+
+
+def grib_name(gid):
+    key = (eccodes.codes_get(gid, 'discipline'), eccodes.codes_get(gid, 'parameterCategory'), eccodes.codes_get(gid, 'parameterNumber'))
+    level = eccodes.codes_get(gid, 'typeOfFirstFixedSurface')
+    name = hrrr_names.get(key, f"var{key[0]}_{key[1]}_{key[2]}")
+    if name == 'PWAT': return 'PWAT_entireatmosphere_consideredasasinglelayer_'
+    if name == 'VVEL': return f"VVEL_{round(eccodes.codes_get(gid, 'level'))}mb"
+    if name in ['CAPE', 'CIN']: return f"{name}_255M0mbaboveground"
+    if name == 'HGT': return 'HGT_equilibriumlevel' if level == 247 else 'HGT_leveloffreeconvection'
+    return f"{name}_{level}"
+
+
+def grib_grid(gid):
+    ni = eccodes.codes_get(gid, 'Ni')
+    nj = eccodes.codes_get(gid, 'Nj')
+    if eccodes.codes_get(gid, 'gridType') == 'regular_ll':
+        lat = np.linspace(eccodes.codes_get(gid, 'latitudeOfFirstGridPointInDegrees'), eccodes.codes_get(gid, 'latitudeOfLastGridPointInDegrees'), nj)
+        lon = np.linspace(eccodes.codes_get(gid, 'longitudeOfFirstGridPointInDegrees'), eccodes.codes_get(gid, 'longitudeOfLastGridPointInDegrees'), ni)
+        return lat, lon
+    lat = eccodes.codes_get_array(gid, 'latitudes').reshape(nj, ni)
+    lon = eccodes.codes_get_array(gid, 'longitudes').reshape(nj, ni)
+    return lat, lon
+
+
+def decode_grib(buf, name=None):
+    # gzip bytes are inflated in memory; returns ({name: values}, valid time, lat, lon)
+    if buf[:2] == b'\x1f\x8b': buf = gzip.decompress(buf)
+    fields = {}
+    stamp = lat = lon = None
+    for message in split_messages(buf):
+        gid = eccodes.codes_new_from_message(message)
+        try:
+            if lat is None:
+                lat, lon = grib_grid(gid)
+                stamp = datetime.strptime(f"{eccodes.codes_get(gid, 'validityDate')}{eccodes.codes_get(gid, 'validityTime'):04d}", "%Y%m%d%H%M")
+            shape = (eccodes.codes_get(gid, 'Nj'), eccodes.codes_get(gid, 'Ni'))
+            values = eccodes.codes_get_values(gid).astype(np.float32)
+            if eccodes.codes_get(gid, 'bitmapPresent'):
+                values[values == eccodes.codes_get(gid, 'missingValue')] = np.nan
+            fields[name if name is not None else grib_name(gid)] = values.reshape(shape)
+        finally: eccodes.codes_release(gid)
+    return fields, stamp, lat, lon
+
+
+def read_grib(path, name=None):
+    with open(path, 'rb') as file: return decode_grib(file.read(), name)
+
+
+def grib_dataset(frames):
+    frames = sorted(frames, key=lambda frame: frame[1])
+    fields, stamp, lat, lon = frames[0]
+    if lat.ndim == 1:
+        dims = ('latitude', 'longitude')
+        coords = {'latitude': ('latitude', lat, _lat_attrs), 'longitude': ('longitude', lon, _lon_attrs)}
+    else:
+        dims = ('y', 'x')
+        coords = {'latitude': (dims, lat, _lat_attrs), 'longitude': (dims, lon, _lon_attrs)}
+    coords['time'] = ('time', np.array([frame[1] for frame in frames], dtype='datetime64[ns]'))
+    data = {name: (('time',) + dims, np.stack([frame[0][name] for frame in frames])) for name in fields}
+    return xr.Dataset(data, coords=coords)
+
+
+__all__ = ['mrms_names', 'hrrr_names', 'split_messages', 'grib_name', 'grib_grid', 'decode_grib', 'read_grib', 'grib_dataset']
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import hashlib
+import asyncio
+import numpy as np
+import h5py
+from utils.s3_utils import run_async, bounded
+from utils.cache_utils import cache_get
+from utils.regrid_utils import grid_coords, lattice_window, lattice_cache
+
+goes_bands = ['CMI_C02', 'CMI_C07', 'CMI_C13']
+# S3 reads are rounded to whole blocks, and a metadata miss reads a few blocks ahead
+rangeblock = 64 * 1024
+readahead = 4
+headbytes = 1024**2
+_windows = {}
+
+
+class RangeFile(io.RawIOBase):
+    # read-only file over one S3 object, so h5py can open it while only the touched byte ranges are fetched
+    def __init__(self, bucket, key, size, block=rangeblock):
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.block = block
+        self.blocks = {}
+        self.pos = 0
+        self.fetched = 0
+        self.requests = 0
+
+    def readable(self): return True
+
+    def seekable(self): return True
+
+    def tell(self): return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.pos = [offset, self.pos + offset, self.size + offset][whence]
+        return self.pos
+
+    def missing(self, start, end):
+        # contiguous runs of absent blocks covering bytes [start, end), as byte ranges
+        runs = []
+        for k in range(start // self.block, (min(end, self.size) - 1) // self.block + 1):
+            if k in self.blocks: continue
+            if runs and runs[-1][1] == k: runs[-1][1] = k + 1
+            else: runs.append([k, k + 1])
+        return [(a * self.block, min(b * self.block, self.size)) for a, b in runs]
+
+    def store(self, start, data):
+        self.fetched += len(data)
+        self.requests += 1
+        for offset in range(0, len(data), self.block):
+            self.blocks[(start + offset) // self.block] = data[offset:offset+self.block]
+
+    def fill(self, start, end):
+        # h5py's own reads run on executor threads, never on the loop, so they wait on the shared client like any other caller
+        run_async(lambda aio: self.afill(aio, [(start, end)]))
+
+    async def afill(self, aio, extents):
+        spans = sorted({span for start, end in extents for span in self.missing(start, end)})
+        bodies = await asyncio.gather(*(aio.get(self.bucket, self.key, a, b) for a, b in spans))
+        for (a, b), body in zip(spans, bodies): self.store(a, body)
+
+    def readinto(self, buf):
+        n = min(len(buf), self.size - self.pos)
+        if n <= 0: return 0
+        if self.missing(self.pos, self.pos + n): self.fill(self.pos, self.pos + n + readahead * self.block)
+        out = memoryview(buf)
+        done = 0
+        while done < n:
+            k, offset = divmod(self.pos, self.block)
+            piece = self.blocks[k][offset:offset + n - done]
+            out[done:done+len(piece)] = piece
+            done += len(piece)
+            self.pos += len(piece)
+        return n
+
+
+def _value(obj, name):
+    return float(np.ravel(obj.attrs[name])[0])
+
+
+def geos_proj(h5):
+    proj = h5['goes_imager_projection']
+    return {
+        'h': _value(proj, 'perspective_point_height'),
+        'req': _value(proj, 'semi_major_axis'),
+        'rpol': _value(proj, 'semi_minor_axis'),
+        'lon0': _value(proj, 'longitude_of_projection_origin'),
+    }
+
+
+def scan_axes(h5):
+    # fixed-grid scan angles in radians; x runs west to east, y north to south
+    axes = []
+    for name in ['x', 'y']:
+        var = h5[name]
+        axes.append(var[:].astype(np.float64) * _value(var, 'scale_factor') + _value(var, 'add_offset'))
+    return axes
+
+
+def geos_forward(lat, lon, proj):
+    # geodetic lat/lon to fixed-grid scan angles (GOES-R PUG vol. 4, 4.2.8.1), with the limb visibility test
+    req, rpol = proj['req'], proj['rpol']
+    H = proj['h'] + req
+    lat = np.deg2rad(lat)
+    lon = np.deg2rad(lon) - np.deg2rad(proj['lon0'])
+    latc = np.arctan((rpol**2 / req**2) * np.tan(lat))
+    rc = rpol / np.sqrt(1 - (1 - rpol**2 / req**2) * np.cos(latc)**2)
+    sx = H - rc * np.cos(latc) * np.cos(lon)
+    sy = -rc * np.cos(latc) * np.sin(lon)
+    sz = rc * np.sin(latc)
+    x = np.arcsin(-sy / np.sqrt(sx**2 + sy**2 + sz**2))
+    y = np.arctan(sz / sx)
+    visible = H * (H - sx) >= sy**2 + (req**2 / rpol**2) * sz**2
+    return x, y, visible
+
+
+def scan_lookup(tlat, tlon, x, y, proj, rows=250):
+    # nearest fixed-grid pixel for every point of a lat/lon grid; x and y are evenly spaced
+    iy = np.empty((len(tlat), len(tlon)), dtype=np.int32)
+    ix = np.empty((len(tlat), len(tlon)), dtype=np.int32)
+    valid = np.empty((len(tlat), len(tlon)), dtype=bool)
+    for r in range(0, len(tlat), rows):
+        glat, glon = np.meshgrid(tlat[r:r+rows], tlon, indexing='ij')
+        sx, sy, visible = geos_forward(glat, glon, proj)
+        jx = np.rint((sx - x[0]) / (x[1] - x[0]))
+        jy = np.rint((sy - y[0]) / (y[1] - y[0]))
+        ok = visible & (jx >= 0) & (jx < len(x)) & (jy >= 0) & (jy < len(y))
+        iy[r:r+rows] = np.where(ok, jy, 0)
+        ix[r:r+rows] = np.where(ok, jx, 0)
+        valid[r:r+rows] = ok
+    return iy, ix, valid
+
+
+def geos_key(x, y, proj):
+    # the fixed grid is set by the projection and the two scan-angle axes
+    spec = [proj[name] for name in sorted(proj)] + [x[0], x[1] - x[0], len(x), y[0], y[1] - y[0], len(y)]
+    return "geos_" + hashlib.sha1(repr([round(float(value), 12) for value in spec]).encode()).hexdigest()[:16]
+
+
+def scan_index(grid, x, y, proj):
+    # lattice windows are slices of one cached CONUS lookup; any other grid is projected once per process
+    key = geos_key(x, y, proj)
+    window = lattice_window(grid)
+    if window is not None:
+        iy, ix, valid = lattice_cache(key, lambda tlat, tlon: scan_lookup(tlat, tlon, x, y, proj))
+        return np.asarray(iy[window]), np.asarray(ix[window]), np.asarray(valid[window])
+    wkey = (key, tuple(sorted(grid.items())))
+    if wkey not in _windows: _windows[wkey] = scan_lookup(*grid_coords(grid), x, y, proj)
+    return _windows[wkey]
+
+
+def footprint(index):
+    iy, ix, valid = index
+    if not valid.any(): return slice(0, 1), slice(0, 1)
+    return slice(int(iy[valid].min()), int(iy[valid].max()) + 1), slice(int(ix[valid].min()), int(ix[valid].max()) + 1)
+
+
+def chunk_extents(dset, box):
+    # byte ranges of the stored chunks a (rows, cols) box touches, read from the HDF5 chunk index
+    rows, cols = box
+    if dset.chunks is None:
+        offset = dset.id.get_offset()
+        if offset is None: return []
+        row = dset.shape[1] * dset.dtype.itemsize
+        return [(offset + rows.start * row, offset + rows.stop * row)]
+    cy, cx = dset.chunks
+    extents = []
+    for r in range(rows.start // cy * cy, rows.stop, cy):
+        for c in range(cols.start // cx * cx, cols.stop, cx):
+            info = dset.id.get_chunk_info_by_coord((r, c))
+            if info.byte_offset is not None: extents.append((info.byte_offset, info.byte_offset + info.size))
+    return extents
+
+
+def decode_band(dset, block):
+    # packed integers to physical values, fill to NaN
+    raw = block
+    if np.ravel(dset.attrs.get('_Unsigned', [b'false']))[0] in [b'true', 'true']: block = block.view(np.dtype(block.dtype.str.replace('i', 'u')))
+    data = block.astype(np.float32)
+    if '_FillValue' in dset.attrs: data[raw == np.ravel(dset.attrs['_FillValue'])[0]] = np.nan
+    if 'scale_factor' in dset.attrs: data = data * np.float32(_value(dset, 'scale_factor')) + np.float32(_value(dset, 'add_offset'))
+    return data
+
+
+def _plan(h5, grids, bands):
+    proj = geos_proj(h5)
+    x, y = scan_axes(h5)
+    indexes = [scan_index(grid, x, y, proj) for grid in grids]
+    boxes = [footprint(index) for index in indexes]
+    extents = [extent for band in bands for box in boxes for extent in chunk_extents(h5[band], box)]
+    return indexes, boxes, extents
+
+
+def _boxes(h5, boxes, bands):
+    # each window's footprint of every band, decoded, as (band, rows, cols)
+    return [np.stack([decode_band(h5[band], h5[band][rows, cols]) for band in bands]) for rows, cols in boxes]
+
+
+def _read_local(path, grids, bands):
+    with h5py.File(path, 'r') as h5:
+        indexes, boxes, extents = _plan(h5, grids, bands)
+        return indexes, boxes, _boxes(h5, boxes, bands)
+
+
+async def read_scan(aio, bucket, key, grids, bands=goes_bands):
+    # one MCMIPC scan cut to each window: header and chunk index first, then only the chunks the windows touch
+    local = cache_get(bucket, key)
+    if local is not None: return await aio.run(_read_local, local, grids, bands)
+    size = await aio.size(bucket, key)
+    rf = RangeFile(bucket, key, size)
+    await rf.afill(aio, [(0, min(headbytes, size))])
+    h5 = await aio.run(h5py.File, rf, 'r')
+    try:
+        indexes, boxes, extents = await aio.run(_plan, h5, grids, bands)
+        await rf.afill(aio, extents)
+        return indexes, boxes, await aio.run(_boxes, h5, boxes, bands)
+    finally: h5.close()
+
+
+def reproject(blocks, index, box):
+    # every band and timestep of one window in a single gather from the stacked (time, band, rows, cols) footprints
+    iy, ix, valid = index
+    rows, cols = box
+    stack = np.stack(blocks)
+    data = stack[..., np.clip(iy - rows.start, 0, stack.shape[-2] - 1), np.clip(ix - cols.start, 0, stack.shape[-1] - 1)]
+    return np.where(valid, data, np.nan).astype(np.float32)
+
+
+def read_scans(bucket, keys, grids, bands=goes_bands, threads=16):
+    # every scan read concurrently; returns one (time, band, ysize, xsize) array per grid
+    scans = run_async(lambda aio: bounded(threads, [read_scan(aio, bucket, key, grids, bands) for key in keys]))
+    indexes, boxes, blocks = scans[0]
+    return [reproject([scan[2][g] for scan in scans], indexes[g], boxes[g]) for g in range(len(grids))]
+
+
+__all__ = ['goes_bands', 'RangeFile', 'geos_proj', 'scan_axes', 'geos_forward', 'scan_lookup', 'geos_key', 'scan_index', 'footprint', 'chunk_extents', 'decode_band', 'read_scan', 'reproject', 'read_scans']
@@ -2,16 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import os
-import gzip
+import json
 import shutil
-import fnmatch
+import hashlib
 import argparse
-import subprocess
 import numpy as np
 import xarray as xr
-from . import s3, cdo, datdir
+from . import datdir
 from datetime import timedelta
-from scipy.ndimage import convolve
+from utils.s3_utils import list_keys, list_many
+from utils.regrid_utils import remap, grid_dataset, lattice_window, lattice_fields
+from utils.screen_utils import cref_summary, window_count
+from utils.target_utils import sample_target
+from utils.check_utils import check_sample
+from utils.time_utils import time_axis, hold_time
+from utils.metrics_utils import count, reason
+
+elevpath = "./perm_elev.nc"
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -20,52 +28,72 @@ def parse_args():
     parser.add_argument('--end', required=True)
     parser.add_argument('--files', type=int, required=True)
     parser.add_argument('--grids', type=int, required=True)
+    parser.add_argument('--batch', type=int, default=1, help='Windows drawn per timestamp from one set of downloads')
+    parser.add_argument('--screened', action='store_true', help='Draw windows only from areas the hourly CREF summary says pass')
+    parser.add_argument('--tiles', action='store_true', help='Cut every window of an overlapping tile grid from each timestamp instead of drawing windows; --grids then counts timestamps')
+    parser.add_argument('--stride', type=int, default=200, help='Pixels between tile origins with --tiles')
+    parser.add_argument('--hrrr_threads', type=int, default=2, help='HRRR cycles fetched and decoded at once per sample')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes in the persistent worker pool')
+    parser.add_argument('--fresh', action='store_true', help='Ignore the manifest and rebuild every sample')
+    parser.add_argument('--seed', type=int, default=0, help='Sampler seed, so a restarted run draws the same samples')
+    parser.add_argument('--store', action='store_true', help='Append finished samples to one consolidated zarr store and drop their per-sample stores')
+    parser.add_argument('--shards', type=int, default=1, help='Number of consolidated stores samples are spread over')
+    parser.add_argument('--limits', type=str, default='', help='Per-stage concurrency, e.g. fetch=8,decode=4,merge=4,validate=2,target=2,store=1')
     return parser.parse_args()
 
         
-def create_dir(folder_name):
-    try: shutil.rmtree(os.path.join('..', datdir, folder_name))
-    except: pass
+def create_dir(folder_name, clean=True):
+    if clean:
+        try: shutil.rmtree(os.path.join('..', datdir, folder_name))
+        except: pass
     current_directory = os.getcwd()
     parent_directory = os.path.abspath(os.path.join(current_directory, '..'))
     main_folder_path = os.path.join(parent_directory, datdir, folder_name)
     os.makedirs(main_folder_path, exist_ok=True)
     backup_folder_path = os.path.join(main_folder_path, 'backup')
     os.makedirs(backup_folder_path, exist_ok=True)
-    subfolders = ['goes', 'hrrr', 'rf-10', 'elev']
+    subfolders = ['goes', 'hrrr', 'rf-10']
     for subfolder in subfolders:
         subfolder_path = os.path.join(backup_folder_path, subfolder)
         os.makedirs(subfolder_path, exist_ok=True)
 
 
 def list_files_s3(bucket, prefix):
-    response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
-    if 'Contents' in response:
-        files = [obj['Key'] for obj in response['Contents']]
-        return files
-    else: return []
-
-
-def elev_time(dirname, etime):
-    cdo.remapnn("./mygrid", input="-setmisstoc,0 ./perm_elev.nc", options="-f nc4", output=f"../{datdir}/{dirname}/backup/elev/og_elev.nc")
-    etime -= timedelta(hours=2)
-    for i in range(2):
-        etime += timedelta(hours=1)
-        etime_str = etime.strftime("%Y-%m-%d,%H:%M:00,5min")
-        cdo.settaxis(f"{etime_str}", input=f"../{datdir}/{dirname}/backup/elev/og_elev.nc", options="-f nc4 -r", output=f"../{datdir}/{dirname}/backup/elev/elev{i}.nc")
-    etime -= timedelta(hours=1)
-    etime_str = etime.strftime("%Y-%m-%d,%H:%M:00,5min")
-    cdo.inttime(f"{etime_str}", input=f"-mergetime ../{datdir}/{dirname}/backup/elev/elev0.nc ../{datdir}/{dirname}/backup/elev/elev1.nc", options="-b F32 -f nc4 -r", output=f"../{datdir}/{dirname}/backup/elev.nc")
-
-
-def merge_ins(dirname, ygrd, xgrd):
-    try:
-        ds1 = xr.open_dataset(f"../{datdir}/{dirname}/backup/goes.nc", chunks={'time': 1, 'lat': ygrd, 'lon': xgrd})
-        ds2 = xr.open_dataset(f"../{datdir}/{dirname}/backup/hrrr.nc", chunks={'time': 1, 'lat': ygrd, 'lon': xgrd})
-        ds3 = xr.open_dataset(f"../{datdir}/{dirname}/backup/elev.nc", chunks={'time': 1, 'lat': ygrd, 'lon': xgrd})
-        ds = xr.merge([ds1, ds2, ds3])
-        ds.to_zarr(f"../{datdir}/{dirname}/inputs.zarr", mode='w', consolidated=True)
-    except: pass
+    return list_keys(bucket, prefix)
+
+
+def elev_lattice(path=elevpath):
+    # keyed on the file's size and mtime, so replacing perm_elev.nc rebuilds the lattice copy
+    stat = os.stat(path)
+    key = "elev_" + hashlib.sha1(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+    def build(grid):
+        with xr.open_dataset(path) as ds:
+            if 'time' in ds.dims: ds = ds.isel(time=0, drop=True)
+            return remap(ds.fillna(0), grid)
+    return lattice_fields(key, build)
+
+
+def elev_time(etime, grid):
+    # the static field held over the same 13 5-minute steps as the other inputs: a slice of the lattice copy, broadcast
+    times = time_axis(etime - timedelta(hours=1))
+    window = lattice_window(grid)
+    if window is None:
+        with xr.open_dataset(elevpath) as ds: return hold_time(remap(ds.fillna(0), grid), times)
+    out = grid_dataset(grid)
+    out.coords['time'] = ('time', times)
+    for name, (field, attrs) in elev_lattice().items():
+        data = field[window]
+        out[name] = (('time', 'lat', 'lon'), np.broadcast_to(data, (len(times), ) + data.shape), attrs)
+    return out
+
+
+def merge_ins(dirname, ygrd, xgrd, etime, grid):
+    # failures propagate, so the scheduler's retry log and the metrics carry the real reason
+    ds1 = xr.open_dataset(f"../{datdir}/{dirname}/backup/goes.nc", chunks={'time': 1, 'lat': ygrd, 'lon': xgrd})
+    ds2 = xr.open_dataset(f"../{datdir}/{dirname}/backup/hrrr.nc", chunks={'time': 1, 'lat': ygrd, 'lon': xgrd})
+    ds3 = elev_time(etime, grid).chunk({'time': 1, 'lat': ygrd, 'lon': xgrd})
+    ds = xr.merge([ds1, ds2, ds3])
+    ds.to_zarr(f"../{datdir}/{dirname}/inputs.zarr", mode='w', consolidated=True)
 
 
 def locate_data(indate, mrmsprod1, delaytime):
@@ -76,6 +104,11 @@ def locate_data(indate, mrmsprod1, delaytime):
     fdate = indate + timedelta(hours=1)
     pymd = pdate.strftime("%Y%m%d")
     fymd = fdate.strftime("%Y%m%d")
+    # every listing below is requested at once, then read back from the listing memo
+    pairs = [("noaa-mrms-pds", f"CONUS/{mrmsprod1}/{pymd}/"), ("noaa-hrrr-bdp-pds", f"hrrr.{pymd}/conus/")]
+    if pymd == fymd: pairs.append(("noaa-goes16", f"ABI-L1b-RadC/{pdate:%Y}/{pdate.timetuple().tm_yday:03d}/00/"))
+    else: pairs += [("noaa-goes16", f"ABI-L1b-RadC/{pdate:%Y}/{pdate.timetuple().tm_yday:03d}/23/"), ("noaa-mrms-pds", f"CONUS/{mrmsprod1}/{fymd}/"), ("noaa-goes16", f"ABI-L1b-RadC/{fdate:%Y}/{fdate.timetuple().tm_yday:03d}/00/"), ("noaa-hrrr-bdp-pds", f"hrrr.{fymd}/conus/")]
+    list_many(pairs)
     
     if pymd == fymd:
         counter = 0
@@ -118,105 +151,46 @@ def locate_data(indate, mrmsprod1, delaytime):
 
 
 def process_data(dirname, remove):
+    # nan counts, ranges and chunk presence per variable, from the zarr metadata and one read per array
+    report = check_sample(dirname)
+    with open("../data_info/validation.jsonl", "a") as file: file.write(json.dumps(report) + "\n")
+    for prod, store in report['stores'].items():
+        for error in store['errors']:
+            with open("../data_info/warnings.txt", "a") as file: file.write(f"{dirname} {prod}.zarr: {error}" + "\n")
+    print("\n" + f"Done processing {dirname}" + "\n")
+    return report['ok']
+
+
+def check_insts(crtim, ref, num, grids):
+    # answered from the hourly CREF summary, which is downloaded and built once per hour
+    flags = [0] * len(grids)
     try:
-        i = 0
-        for prod in ["inputs", "mrms"]:
-            ds = xr.open_zarr(f"../{datdir}/{dirname}/{prod}.zarr")
-            for variable in ds.variables:
-                for timestep in ds.time:
-                    try:
-                        data = ds[variable].sel(time=timestep).values
-                        nan_indices = np.isnan(data)
-                        if np.any(nan_indices):
-                            i += 1
-                    except: pass
-        if i > 0:
-            with open("../data_info/warnings.txt", "a") as file: file.write(f"{dirname} contains NaN" + "\n")
-        inputs_num = 0
-        target_num = 0
-        folder_path = f"../{datdir}/{dirname}/inputs.zarr"
-        for root, dirs, files in os.walk(folder_path): inputs_num += len(files)
-        folder_path = f"../{datdir}/{dirname}/mrms.zarr"
-        for root, dirs, files in os.walk(folder_path): target_num += len(files)
-        if (inputs_num != 177 or target_num != 27):
-            i+=1
-            with open("../data_info/warnings.txt", "a") as file: file.write(f"{dirname} contains {inputs_num} inputs and {target_num} mrms" + "\n")
-        print("\n" + f"Done processing {dirname}" + "\n")
-    except:
-        with open("../data_info/warnings.txt", "a") as file: file.write(f"{dirname} contains no zarr" + "\n")
-        print("\n" + f"Done processing {dirname}" + "\n")
-
-
-def check_inst(dirname, crtim, ref, num):
-    flag = 0
-    try:
-        try: shutil.rmtree(f"../{datdir}/{dirname}/")
-        except: pass
-        os.makedirs(f"../{datdir}/{dirname}")
-        crtim += timedelta(hours=1)
-        if crtim.minute >= 30: crtim += timedelta(hours=1)
-        crtim = crtim.replace(minute=0)
-        date_str = crtim.strftime("%Y%m%d")
-        time_str = crtim.strftime("%H%M")
-        files_in_directory = list_files_s3("noaa-mrms-pds", f"CONUS/CREF_1HR_MAX_00.50/{date_str}/")
-        matching_files = [file for file in files_in_directory if fnmatch.fnmatch(file, f"*{date_str}-{time_str}*")]
-        file_down = matching_files[0]
-        file_pt1 = crtim.strftime("%Y%m%d-%H%M")
-        file_newname = f"CREF_1HR_MAX_00.50_{file_pt1}.grib2.gz"
-        gbname = f"CREF_1HR_MAX_00.50_{file_pt1}.grib2"
-        ncname = f"CREF_1HR_MAX_00.50_{file_pt1}.nc"
-        rname = f"CREF_1HR_MAX_00.50_{file_pt1}_r.nc"
-        s3.download_file("noaa-mrms-pds", file_down, f"../{datdir}/{dirname}/{file_newname}")
-        with gzip.open(f"../{datdir}/{dirname}/{file_newname}", 'rb') as f_in, open(f"../{datdir}/{dirname}/{file_newname}"[:-3], 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-        os.remove(f"../{datdir}/{dirname}/{file_newname}")
-        tonc = [
-            "bash", "-c",
-            f"wgrib2 ../{datdir}/{dirname}/{gbname} -nc4 -netcdf ../{datdir}/{dirname}/{ncname}"
-        ]
-        subprocess.run(tonc)
-        cdo.remapnn("./mygrid", input=f"../{datdir}/{dirname}/{ncname}", output=f"../{datdir}/{dirname}/{rname}")
-        ds = xr.open_dataset(f"../{datdir}/{dirname}/{rname}")
-        cref = ds["ReflectivityCompositeHourlyMax_500mabovemeansealevel"]
-        thrs = xr.where(cref >= ref, 1, 0)
-        if thrs.sum() >= num: flag = 1
-        shutil.rmtree(f"../{datdir}/{dirname}/")
-        ds.close()
-    except: pass
-    return flag
+        summary = cref_summary(crtim, ref)
+        if summary is None: return flags
+        for k, grid in enumerate(grids):
+            if window_count(summary, grid) >= num: flags[k] = 1
+    except Exception as e:
+        # a screening failure still rejects the windows, but is counted and logged instead of vanishing
+        count('screen_errors', reason=type(e).__name__)
+        with open("../data_info/warnings.txt", "a") as file: file.write(f"{crtim:%Y%m%d_%H%M} screening failed ({reason(e)})" + "\n")
+    return flags
+
+
+def check_inst(crtim, ref, num, grid):
+    return check_insts(crtim, ref, num, [grid])[0]
 
 
 def make_target(dirname, ref, cape, cin, tch):
     try:
-        mrms = xr.open_zarr(f"../{datdir}/{dirname}/mrms.zarr")
-        ins = xr.open_zarr(f"../{datdir}/{dirname}/inputs.zarr")
-        newds = xr.Dataset()
-        tpar = []
-        for i in range(0, 13):
-            iref = mrms["ReflectivityM10C_500mabovemeansealevel"].isel(time=i)
-            mucp = ins["CAPE_255M0mbaboveground"].isel(time=12)
-            mucn = ins["CIN_255M0mbaboveground"].isel(time=12)
-            rffg = xr.where(iref >= ref, 1, 0)
-            cpfg = xr.where(mucp >= cape, 1, 0)
-            cnfg = xr.where(mucn >= cin, 1, 0)
-            targ = xr.where((rffg == 1) & (cpfg == 1) & (cnfg == 1), 1, 0)
-            tpar.append(targ)
-        tpar_concat = xr.concat(tpar, dim='time')
-        tpar_sum = tpar_concat.sum(dim='time')
-        time_coords = mrms["time"].isel(time=0)
-        newds["time"] = time_coords
-        kernel = np.ones((3, 3))
-        target_data = tpar_sum.data
-        convolved = convolve(target_data, kernel, mode='constant', cval=0)
-        newds["target"] = xr.where((tpar_sum >= 1) & (convolved >= (tch+1)), 1, 0)
-        instances = newds["target"].sum().compute()
-        print("\n" + f"Instances of convective initiation in {dirname}: {instances.values}" + "\n")
+        newds = sample_target(dirname, ref, cape, cin, tch)
+        instances = int(newds["target"].sum())
+        print("\n" + f"Instances of convective initiation in {dirname}: {instances}" + "\n")
         with open("../data_info/instances.txt", "a") as file:
-            file.write(f"Instances of convective initiation in {dirname}: {instances.values}" + "\n")
+            file.write(f"Instances of convective initiation in {dirname}: {instances}" + "\n")
         newds.to_zarr(f"../{datdir}/{dirname}/target.zarr", mode='w', consolidated=True)
     except Exception as e:
         with open("../data_info/instances.txt", "a") as file:
             file.write(f"Error in {dirname}: {e}" + "\n")
 
 
-__all__ = ['parse_args', 'create_dir', 'list_files_s3', 'elev_time', 'merge_ins', 'locate_data', 'process_data', 'check_inst', 'make_target']
\ No newline at end of file
+__all__ = ['elevpath', 'parse_args', 'create_dir', 'list_files_s3', 'elev_lattice', 'elev_time', 'merge_ins', 'locate_data', 'process_data', 'check_insts', 'check_inst', 'make_target']
\ No newline at end of file
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import queue
+import threading
+import numpy as np
+import zarr
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from . import datdir, cachedir
+from utils.decode_utils import mrms_names
+
+# every sample the loader can serve, rebuilt whenever ../data gains or loses a sample or a store grows;
+# it lives outside ../data so writing it does not itself make the index stale
+indexpath = os.path.join('..', cachedir, 'loader_index.json')
+cache_bytes = 4 * 1024**3
+
+
+def _dims(arr):
+    if arr.metadata.zarr_format == 2: return tuple(arr.attrs.get('_ARRAY_DIMENSIONS', ()))
+    return tuple(arr.metadata.dimension_names or ())
+
+
+def _sample_vars(group):
+    # per-sample inputs.zarr: every (time, lat, lon) array, in name order
+    return sorted(name for name, arr in group.arrays() if _dims(arr) == ('time', 'lat', 'lon'))
+
+
+def _store_vars(group):
+    # consolidated stores hold inputs and mrms together; the mrms fields are what the target is cut from, not inputs
+    return sorted(name for name, arr in group.arrays() if _dims(arr) == ('sample', 'step', 'y', 'x') and name not in mrms_names.values())
+
+
+def _stores(root):
+    return sorted(os.path.join(root, item) for item in os.listdir(root) if item.startswith('dataset') and item.endswith('.zarr'))
+
+
+def _size(path):
+    try:
+        with open(f"{path}/sample/.zarray", 'r') as file: return json.load(file)['shape'][0]
+    except (OSError, ValueError, KeyError): return None
+
+
+def index_key(root=os.path.join('..', datdir)):
+    # cheap to compute: the finished per-sample dirs by name, and each store's sample count and metadata stamp
+    dirs = [item for item in sorted(os.listdir(root)) if item.startswith('20') and os.path.exists(os.path.join(root, item, 'inputs.zarr')) and os.path.exists(os.path.join(root, item, 'target.zarr'))]
+    stores = []
+    for path in _stores(root):
+        meta = os.path.join(path, '.zmetadata')
+        stores.append([path, _size(path), os.stat(meta).st_mtime_ns if os.path.exists(meta) else None])
+    return {'root': os.path.abspath(root), 'dirs': dirs, 'stores': stores}
+
+
+def scan_samples(root=os.path.join('..', datdir)):
+    entries = []
+    names = None
+    key = index_key(root)
+    for path in _stores(root):
+        group = zarr.open_group(path, mode='r')
+        if names is None: names = _store_vars(group)
+        entries.extend([str(name), path, k] for k, name in enumerate(group['sample'][:].tolist()))
+    # pack.py keeps the per-sample stores by default, so a sample already in a store is served from there only
+    stored = {entry[0] for entry in entries}
+    for item in key['dirs']:
+        base = os.path.join(root, item)
+        if item not in stored:
+            if names is None: names = _sample_vars(zarr.open_group(f"{base}/inputs.zarr", mode='r'))
+            entries.append([item, base, None])
+    return {'key': key, 'vars': names or [], 'samples': entries}
+
+
+def build_index(root=os.path.join('..', datdir), path=indexpath, refresh=False):
+    if not refresh and os.path.exists(path):
+        with open(path, 'r') as file: index = json.load(file)
+        if index.get('key') == index_key(root): return index
+    index = scan_samples(root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.{os.getpid()}.tmp", 'w') as file: json.dump(index, file)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+    return index
+
+
+class Loader:
+    # shuffled (batch, time, var, lat, lon) inputs and (batch, lat, lon) targets, read ahead on a thread pool
+    def __init__(self, index=None, batch=16, names=None, shuffle=True, seed=0, threads=8, prefetch=4, cache=cache_bytes, drop_last=False):
+        self.index = index or build_index()
+        self.names = names or self.index['vars']
+        self.batch = batch
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.threads = threads
+        self.prefetch = prefetch
+        self.cache = cache
+        self.drop_last = drop_last
+        self.cached = OrderedDict()
+        self.used = 0
+        self.groups = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        n = len(self.index['samples'])
+        return n // self.batch if self.drop_last else -(-n // self.batch)
+
+    def _group(self, path):
+        # stores stay open for the life of the loader, so each is opened and its metadata parsed once
+        with self.lock:
+            if path not in self.groups: self.groups[path] = zarr.open_group(path, mode='r')
+            return self.groups[path]
+
+    def _read(self, entry):
+        name, base, k = entry
+        if k is None:
+            ins, target = self._group(f"{base}/inputs.zarr"), self._group(f"{base}/target.zarr")
+            x = np.stack([np.asarray(ins[var][...], dtype=np.float32) for var in self.names], axis=1)
+            return x, np.asarray(target['target'][...], dtype=np.int8)
+        group = self._group(base)
+        x = np.stack([np.asarray(group[var][k], dtype=np.float32) for var in self.names], axis=1)
+        return x, np.asarray(group['target'][k], dtype=np.int8)
+
+    def sample(self, entry):
+        # least recently used samples are evicted once the decoded arrays pass the cache budget
+        key = (entry[1], entry[2])
+        with self.lock:
+            if key in self.cached:
+                self.cached.move_to_end(key)
+                self.hits += 1
+                return self.cached[key]
+        found = self._read(entry)
+        with self.lock:
+            self.misses += 1
+            if key not in self.cached and self.cache > 0:
+                self.cached[key] = found
+                self.used += found[0].nbytes + found[1].nbytes
+                while self.used > self.cache and len(self.cached) > 1:
+                    x, y = self.cached.popitem(last=False)[1]
+                    self.used -= x.nbytes + y.nbytes
+        return found
+
+    def _assemble(self, pool, entries):
+        found = list(pool.map(self.sample, entries))
+        x = np.empty((len(found), ) + found[0][0].shape, dtype=np.float32)
+        y = np.empty((len(found), ) + found[0][1].shape, dtype=np.int8)
+        for k, (xs, ys) in enumerate(found):
+            x[k] = xs
+            y[k] = ys
+        return x, y, [entry[0] for entry in entries]
+
+    def batches(self):
+        samples = self.index['samples']
+        order = self.rng.permutation(len(samples)) if self.shuffle else np.arange(len(samples))
+        stop = len(order) - len(order) % self.batch if self.drop_last else len(order)
+        return [[samples[i] for i in order[start:start+self.batch]] for start in range(0, stop, self.batch)]
+
+    def __iter__(self):
+        # one producer thread keeps up to prefetch batches assembled ahead of the consumer
+        ready = queue.Queue(maxsize=max(1, self.prefetch))
+        stop = threading.Event()
+        def put(item):
+            while not stop.is_set():
+                try: return ready.put(item, timeout=0.5)
+                except queue.Full: pass
+        def produce():
+            try:
+                with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                    for entries in self.batches():
+                        if stop.is_set(): return
+                        put(self._assemble(pool, entries))
+            except Exception as e: put(e)
+            finally: put(None)
+        worker = threading.Thread(target=produce, daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is None: return
+                if isinstance(item, Exception): raise item
+                yield item
+        finally:
+            stop.set()
+            worker.join(timeout=5)
+
+
+__all__ = ['indexpath', 'cache_bytes', 'index_key', 'scan_samples', 'build_index', 'Loader']
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from . import datdir
+
+# lives beside the samples so it survives the ../data_info reset of a fresh run
+manifest_path = os.path.join('..', datdir, 'manifest.sqlite')
+
+
+def open_manifest(path=manifest_path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS samples (name TEXT PRIMARY KEY, grp TEXT, time TEXT, xfirst REAL, yfirst REAL, grid TEXT, status TEXT, checksums TEXT, updated REAL)")
+    db.execute("CREATE TABLE IF NOT EXISTS tasks (name TEXT PRIMARY KEY, grp TEXT, stage TEXT, status TEXT, tries INTEGER, updated REAL)")
+    db.commit()
+    return db
+
+
+def record_group(db, group, stamp, samples):
+    for name, grid in samples:
+        db.execute("INSERT OR IGNORE INTO samples VALUES (?, ?, ?, ?, ?, ?, 'pending', NULL, ?)", (name, group, stamp.strftime("%Y-%m-%d %H:%M"), grid['xfirst'], grid['yfirst'], json.dumps(grid), time.time()))
+    db.commit()
+
+
+def group_samples(db, group):
+    rows = db.execute("SELECT name, grid, status FROM samples WHERE grp = ? ORDER BY name", (group, )).fetchall()
+    if not rows: return None
+    return [(name, json.loads(grid)) for name, grid, status in rows], all(status == 'done' for name, grid, status in rows)
+
+
+def mark_task(db, name, stage, status, tries=1):
+    db.execute("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?)", (name, name.split('/')[0], stage, status, tries, time.time()))
+    db.commit()
+
+
+def done_tasks(db, group):
+    return {name for name, in db.execute("SELECT name FROM tasks WHERE grp = ? AND status = 'done'", (group, ))}
+
+
+def store_checksum(path):
+    # order-independent digest over every file of a zarr store
+    digest = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(path)):
+        for file in sorted(files):
+            full = os.path.join(root, file)
+            digest.update(os.path.relpath(full, path).encode())
+            with open(full, 'rb') as f: digest.update(f.read())
+    return digest.hexdigest()
+
+
+def sample_checksums(name, stores=('inputs.zarr', 'mrms.zarr', 'target.zarr')):
+    # runs in the worker that writes the last of a sample's stores, before a store task can remove them
+    checksums = {}
+    for store in stores:
+        path = os.path.join('..', datdir, name, store)
+        if os.path.exists(path): checksums[store] = store_checksum(path)
+    return checksums
+
+
+def record_checksums(db, found):
+    for name, checksums in found.items():
+        db.execute("UPDATE samples SET checksums = ?, updated = ? WHERE name = ?", (json.dumps(checksums), time.time(), name))
+    db.commit()
+
+
+def mark_sample(db, name, status):
+    db.execute("UPDATE samples SET status = ?, updated = ? WHERE name = ?", (status, time.time(), name))
+    db.commit()
+
+
+__all__ = ['manifest_path', 'open_manifest', 'record_group', 'group_samples', 'mark_task', 'done_tasks', 'store_checksum', 'sample_checksums', 'record_checksums', 'mark_sample']
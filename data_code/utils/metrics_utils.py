@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import threading
+import subprocess
+
+# one JSON line per task attempt, and a Prometheus text file rewritten as the run goes
+metricspath = '../data_info/metrics.jsonl'
+prompath = '../data_info/metrics.prom'
+flush_every = 10
+_counters = {}
+_lock = threading.Lock()
+_popen = [None]
+
+
+def count(name, value=1, **labels):
+    # process-local counter; a worker's counts travel back to the scheduler with its task's result
+    key = (name, tuple(sorted(labels.items())))
+    with _lock: _counters[key] = _counters.get(key, 0) + value
+
+
+def take():
+    with _lock:
+        found = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in _counters.items()]
+        _counters.clear()
+    return found
+
+
+def reason(e):
+    return f"{type(e).__name__}: {e}".strip().splitlines()[-1]
+
+
+def track_subprocesses():
+    # every Popen in this process and its forked workers counts as a launch, labelled by program
+    if _popen[0] is not None: return
+    _popen[0] = subprocess.Popen.__init__
+    def launch(self, args, *rest, **kwargs):
+        program = args if isinstance(args, str) else args[0]
+        count('subprocess_launches', program=os.path.basename(str(program).split()[0]))
+        _popen[0](self, args, *rest, **kwargs)
+    subprocess.Popen.__init__ = launch
+
+
+def tracking():
+    return _popen[0] is not None
+
+
+class TaskError(Exception):
+    # what a failed task raises back to the scheduler: the original reason plus the counts gathered before it failed
+    def __init__(self, reason, counters):
+        super().__init__(reason, counters)
+        self.reason = reason
+        self.counters = counters
+
+    def __str__(self):
+        return self.reason
+
+
+def measured(func, *args, **kwargs):
+    # runs in the worker: counters start empty, and come back with the result or inside a TaskError
+    take()
+    try: result = func(*args, **kwargs)
+    except Exception as e: raise TaskError(reason(e), take()) from None
+    return result, take()
+
+
+class Metrics:
+    # scheduler-side sink: task attempts go to the JSON lines file as they finish, totals to the Prometheus file
+    def __init__(self, path=metricspath, prom=prompath):
+        self.path = path
+        self.prom = prom
+        self.totals = {}
+        self.flushed = 0
+        if path: os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _add(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        self.totals[key] = self.totals.get(key, 0) + value
+
+    def record(self, task, status, seconds, counters=(), error=None):
+        line = {'time': time.time(), 'sample': task.name.split('/')[0], 'task': task.name, 'stage': task.stage, 'try': task.tries, 'status': status, 'seconds': round(seconds, 4), 'counters': list(counters)}
+        if error: line['reason'] = error
+        self._add('pipeline_stage_seconds_sum', {'stage': task.stage}, seconds)
+        self._add('pipeline_stage_seconds_count', {'stage': task.stage}, 1)
+        self._add('pipeline_tasks_total', {'stage': task.stage, 'status': status}, 1)
+        if error: self._add('pipeline_task_failures_total', {'stage': task.stage, 'reason': error.split(':')[0]}, 1)
+        for counter in counters: self._add(f"pipeline_{counter['name']}_total", dict(counter['labels'], stage=task.stage), counter['value'])
+        if self.path:
+            with open(self.path, "a") as file: file.write(json.dumps(line) + "\n")
+        if time.time() - self.flushed > flush_every: self.flush()
+
+    def flush(self):
+        # counts gathered in this process itself (screening, sampling) are folded in under stage "sampler"
+        for counter in take(): self._add(f"pipeline_{counter['name']}_total", dict(counter['labels'], stage='sampler'), counter['value'])
+        self.flushed = time.time()
+        if not self.prom: return
+        lines = []
+        families = {}
+        for (name, labels), value in sorted(self.totals.items()):
+            family = name.rsplit('_', 1)[0] if name.startswith('pipeline_stage_seconds_') else name
+            families.setdefault(family, []).append((name, labels, value))
+        for family, samples in families.items():
+            lines.append(f"# TYPE {family} {'summary' if family == 'pipeline_stage_seconds' else 'counter'}")
+            for name, labels, value in samples:
+                text = ",".join('{}="{}"'.format(key, str(label).replace('\\', '\\\\').replace('"', '\\"')) for key, label in labels)
+                lines.append(f"{name}{{{text}}} {value:g}")
+        with open(f"{self.prom}.tmp", "w") as file: file.write("\n".join(lines) + "\n")
+        os.replace(f"{self.prom}.tmp", self.prom)
+
+
+__all__ = ['metricspath', 'prompath', 'count', 'take', 'reason', 'track_subprocesses', 'tracking', 'TaskError', 'measured', 'Metrics']
@@ -2,189 +2,202 @@
 # -*- coding: utf-8 -*-
 
 import os
-import glob
-import gzip
-import shutil
-import fnmatch
-import subprocess
+import hashlib
+import numpy as np
 import pandas as pd
-import xarray as xr
-from . import s3, cdo, datdir
-from herbie import FastHerbie
+from . import datdir, cachedir
+from herbie import Herbie
 from datetime import timedelta
-from utils.helper_utils import list_files_s3
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from utils.s3_utils import find_key, fetch_frames, warm_frames
+from utils.regrid_utils import remap, grid_dataset, cover_grid, cut_window, cut_windows
+from utils.cache_utils import framedir, cache_lock, cache_added
+from utils.decode_utils import mrms_names, read_grib, grib_dataset
+from utils.goes_utils import goes_bands, read_scans
+from utils.metrics_utils import count
+from utils.time_utils import time_axis, mask_range, resample, chunk_encoding
 
+herbdir = os.path.join('..', cachedir, 'herbie')
+# decoded cycles sit under the frame cache, so they share its size cap and least-recently-used eviction
+hrrrdir = os.path.join(framedir, 'hrrr')
+hrrr_search = "PWAT|(VVEL:(700|850|925)|(CAPE:255)|(CIN:255)|(HGT:equilibrium level)|(HGT:((reserved)|(no_level)|(level of free convection))))"
+_cycles = {}
+write_threads = 8
 
-def mrms(dirname, product_long, product_short, mtime, delay, ygrd, xgrd):
+
+def save_windows(jobs, threads=write_threads):
+    # the windows' arrays are already in memory, so each file is only encoding and I/O and goes out on its own thread
+    if len(jobs) == 1: return jobs[0]()
+    with ThreadPoolExecutor(max_workers=max(1, min(threads, len(jobs)))) as pool: list(pool.map(lambda job: job(), jobs))
+
+
+def convert_mrms(file, name):
+    print(f"{os.path.basename(file)} downloaded successfully.")
+    return read_grib(file, name)
+
+
+def mrms_keys(product_long, mtime, delay):
     
     gettim2 = mtime - timedelta(minutes=delay[0])
     modtime = gettim2.minute % 2
     if modtime != 0: gettim2 -= timedelta(minutes=modtime)
     
     x = 0
+    keys = []
     gettim2 += timedelta(minutes=2)
-    while x < 31:
+    # bounded so a gap in the archive fails the task instead of hanging a pooled worker
+    limit = gettim2 + timedelta(hours=3)
+    while x < 31 and gettim2 < limit:
         date_str = gettim2.strftime("%Y%m%d")
-        time_str = gettim2.strftime("%H%M")
-        files_in_directory = list_files_s3("noaa-mrms-pds", f"CONUS/{product_long}/{date_str}/")
-        matching_files = [file for file in files_in_directory if fnmatch.fnmatch(file, f"*{date_str}-{time_str}*")]
-
-        if matching_files:
-            file_down = matching_files[0]
-            file_pt1 = gettim2.strftime("%Y%m%d-%H%M")
-            file_newname = f"{product_short}_{file_pt1}.grib2.gz"
-            s3.download_file("noaa-mrms-pds", file_down, f"../{datdir}/{dirname}/backup/{product_short}/{file_newname}")
-            print(f"{file_newname} downloaded successfully.")
+        file_down = find_key("noaa-mrms-pds", f"CONUS/{product_long}/{date_str}/", gettim2)
+
+        if file_down:
+            keys.append((gettim2, file_down))
             x += 1
         gettim2 += timedelta(minutes=2)
-    
-    files_to_process = glob.glob(f"../{datdir}/{dirname}/backup/{product_short}/*.gz")
-    files_to_process = sorted(files_to_process)
+    if x < 31: raise RuntimeError(f"only {x} of 31 {product_long} frames found after {mtime}")
+    return keys
 
-    for file in files_to_process:
-        with gzip.open(file, 'rb') as f_in, open(file[:-3], 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-        os.remove(file)
-    
-    tonc = [
-        "bash", "-c",
-        f"for file in ../{datdir}/{dirname}/backup/{product_short}/*.grib2; do wgrib2 \"$file\" -nc4 -netcdf \"${{file%.grib2}}.nc\"; done"
-    ]
-    subprocess.run(tonc)
+
+def prefetch_mrms(product_long, mtime, delay):
+    warm_frames("noaa-mrms-pds", [key for stamp, key in mrms_keys(product_long, mtime, delay)])
+
+
+def mrms_steps(out, mtime):
+    # a window's 31 frames relabelled onto 2-minute steps from mtime, echoes at or below 0 and gaps set to 0,
+    # then interpolated onto 13 5-minute steps
+    for name, var in out.data_vars.items(): out[name] = (var.dims, mask_range(var.values, -1000, 0, 0), var.attrs)
+    return resample(out, time_axis(mtime), relabel=(mtime, '2min'))
+
+
+def mrms(dirname, product_long, product_short, mtime, delay, ygrd, xgrd, grids):
     
-    mergetime = [
-        "cdo",
-        "-f", "nc4",
-        "mergetime",
-        f"../{datdir}/{dirname}/backup/{product_short}/*.nc",
-        f"../{datdir}/{dirname}/backup/{product_short}/{product_short}tmp.nc"
-    ]
-    subprocess.run(mergetime)
+    jobs = [(key, f"../{datdir}/{dirname}/backup/{product_short}/{product_short}_{stamp:%Y%m%d-%H%M}.grib2.gz") for stamp, key in mrms_keys(product_long, mtime, delay)]
+    frames = fetch_frames("noaa-mrms-pds", jobs, handler=partial(convert_mrms, name=mrms_names[product_long]))
+    ds = grib_dataset(frames)
     
+    # windows are cut first so only their pixels are resampled
     mtime += timedelta(minutes=5)
-    itime = mtime.strftime("%Y-%m-%d,%H:%M:00")
-    cdo.inttime(f"{itime},5min", input=f"-settaxis,{itime},2min -setmisstoc,0 -setrtomiss,-1000,0 ../{datdir}/{dirname}/backup/{product_short}/{product_short}tmp.nc", options='-f nc4 -r', output=f"../{datdir}/{dirname}/backup/{product_short}/{product_short}tmpp.nc")
-    
-    stime = mtime.strftime("%Y-%m-%d,%H:%M:00,5min")
-    settaxis = [
-        "cdo",
-        "-f", "nc4", "-r",
-        f"settaxis,{stime}",
-        f"../{datdir}/{dirname}/backup/{product_short}/{product_short}tmpp.nc",
-        f"../{datdir}/{dirname}/backup/{product_short}/{product_short}tmppp.nc"
-    ]
-    subprocess.run(settaxis)
-    
-    remap = [
-        "cdo",
-        "-b", "F32", "-f", "nc4",
-        "remapnn,./mygrid",
-        f"../{datdir}/{dirname}/backup/{product_short}/{product_short}tmppp.nc",
-        f"../{datdir}/{dirname}/backup/{product_short}.nc"
-    ]
-    subprocess.run(remap)
-    
-    remove = [f"rm ../{datdir}/{dirname}/backup/{product_short}/*.nc"]
-    subprocess.run(remove, shell=True)
-    
-    try:
-        ds = xr.open_dataset(f"../{datdir}/{dirname}/backup/rf-10.nc", chunks={'time': 1, 'lat': ygrd, 'lon': xgrd})
-        ds.to_zarr(f"../{datdir}/{dirname}/mrms.zarr", mode='w', consolidated=True)
-    except: pass
-
-
-def mfilerdir_hrrr(directory):
-    items = os.listdir(directory)
-    for item in items:
-        item_path = os.path.join(directory, item)
-        if os.path.isdir(item_path):
-            for root, dirs, files in os.walk(item_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    new_file_name = file.split("__", 1)[-1]
-                    original_folder_name = os.path.basename(item_path)
-                    new_path = os.path.join(directory, original_folder_name + "_" + new_file_name)
-                    shutil.move(file_path, new_path)
-            shutil.rmtree(item_path)
-
-
-def hrrr(dirname, htime, thds, delay):
+    windows = cut_windows(grids, lambda grid: mrms_steps(remap(ds, grid), mtime))
+    save_windows([partial(out.to_zarr, f"../{datdir}/{gdir}/mrms.zarr", mode='w', encoding=chunk_encoding(out, {'time': 1, 'lat': ygrd, 'lon': xgrd}), consolidated=True) for gdir, grid, out in windows])
+
+
+def hrrr_cycle(date, fxx, search):
+    # one (cycle, fxx, pattern) subset decoded once into the frame cache and shared by every sample and process after that
+    key = f"{date:%Y%m%d%H}_f{fxx:02d}_{hashlib.sha1(search.encode()).hexdigest()[:12]}"
+    if key in _cycles: return _cycles[key]
+    path = os.path.join(hrrrdir, f"{key}.npz")
+    gridpath = os.path.join(hrrrdir, "grid.npz")
+    with cache_lock(f"hrrr_{key}"):
+        # the grid can be evicted on its own, so a cycle without it is decoded again
+        found = os.path.exists(path) and os.path.exists(gridpath)
+        count('cache_hits' if found else 'cache_misses', kind='hrrr')
+        if found:
+            os.utime(path)
+            os.utime(gridpath)
+        else:
+            H = Herbie(date, model="hrrr", product="prs", fxx=fxx, save_dir=herbdir, verbose=False)
+            subset = H.download(search, save_dir=herbdir, verbose=False)
+            count('s3_calls', bucket='noaa-hrrr-bdp-pds', op='herbie')
+            count('s3_bytes', os.path.getsize(subset), bucket='noaa-hrrr-bdp-pds')
+            fields, stamp, lat, lon = read_grib(subset)
+            os.makedirs(hrrrdir, exist_ok=True)
+            if not os.path.exists(gridpath):
+                np.savez(f"{gridpath}.{os.getpid()}.tmp.npz", lat=lat, lon=lon)
+                os.replace(f"{gridpath}.{os.getpid()}.tmp.npz", gridpath)
+                cache_added(gridpath)
+            np.savez(f"{path}.{os.getpid()}.tmp.npz", stamp=np.datetime64(stamp, 'ns'), **fields)
+            os.replace(f"{path}.{os.getpid()}.tmp.npz", path)
+            os.remove(subset)
+            cache_added(path)
+    if 'grid' not in _cycles:
+        with np.load(gridpath) as saved: _cycles['grid'] = (saved['lat'], saved['lon'])
+    with np.load(path) as saved:
+        fields = {name: saved[name] for name in saved.files if name != 'stamp'}
+        stamp = pd.Timestamp(saved['stamp'][()]).to_pydatetime()
+    if len(_cycles) > 4: _cycles.pop(next(name for name in _cycles if name != 'grid'))
+    _cycles[key] = (fields, stamp) + _cycles['grid']
+    return _cycles[key]
+
+
+def hrrr_fetch(htime, thds, delay):
     
     hrtime = htime - timedelta(hours=1, minutes=delay[1])
     hrtime = hrtime.replace(minute=0)
-    DATES = pd.date_range(start=hrtime.strftime("%Y-%m-%d %H:00"), periods=2, freq="1H",)
-    fxx=range(0,1)
-    data = FastHerbie(DATES, model="hrrr", product="prs", fxx=fxx, max_threads=thds,)
-    data.download(searchString="PWAT|(VVEL:(700|850|925)|(CAPE:255)|(CIN:255)|(HGT:equilibrium level)|(HGT:((reserved)|(no_level)|(level of free convection))))", max_threads=thds, save_dir = f"../{datdir}/{dirname}/backup/")
-    mfilerdir_hrrr(f"../{datdir}/{dirname}/backup/hrrr/")
-    
-    tonc = [
-        "bash", "-c",
-        f"for file in ../{datdir}/{dirname}/backup/hrrr/*.grib2; do wgrib2 \"$file\" -nc4 -netcdf \"${{file%.grib2}}.nc\"; done"
-    ]
-    subprocess.run(tonc)
+    DATES = pd.date_range(start=hrtime.strftime("%Y-%m-%d %H:00"), periods=2, freq="1h",)
+    fxx = 0
+    with ThreadPoolExecutor(max_workers=max(1, thds)) as pool:
+        frames = list(pool.map(lambda date: hrrr_cycle(date.to_pydatetime(), fxx, hrrr_search), DATES))
+    return hrtime, frames
+
+
+def prefetch_hrrr(htime, thds, delay):
+    hrrr_fetch(htime, thds, delay)
+
+
+def hrrr_steps(out, hrtime, htime):
+    # a window's two cycles interpolated onto 5-minute steps from hrtime, relabelled to start an hour before htime
+    out = resample(out, time_axis(hrtime)).assign_coords(time=('time', time_axis(htime - timedelta(hours=1))))
+    depth = out['HGT_equilibriumlevel'] - out['HGT_leveloffreeconvection']
+    out['convdepth'] = np.maximum(depth, 0)
+    return out.drop_vars(['HGT_equilibriumlevel', 'HGT_leveloffreeconvection'])
+
+
+def hrrr(dirname, htime, thds, delay, grids):
     
-    tstime = htime - timedelta(hours=1)
-    stime = tstime.strftime("%Y-%m-%d,%H:%M:00,5min")
-    ltime = hrtime.strftime("%Y-%m-%d,%H:%M:00,5min")
-    h1 = hrtime.strftime("%H")
-    hrtime += timedelta(hours=1)
-    h2 = hrtime.strftime("%H")
-    f1 = glob.glob(f"../{datdir}/{dirname}/backup/hrrr/*t{h1}z*.nc")[0]
-    f2 = glob.glob(f"../{datdir}/{dirname}/backup/hrrr/*t{h2}z*.nc")[0]
-    cdo.remapnn("./mygrid", input=f"-delname,HGT_equilibriumlevel,HGT_leveloffreeconvection -aexpr,'convdepth=((HGT_equilibriumlevel-HGT_leveloffreeconvection)>=0)?(HGT_equilibriumlevel-HGT_leveloffreeconvection):0' -chname,HGT_no_level,HGT_leveloffreeconvection -chname,HGT_reserved,HGT_leveloffreeconvection -settaxis,{stime} -inttime,{ltime} -mergetime {f1} {f2}", options=f"-b F32 -P {thds} -f nc4 -r", output=f"../{datdir}/{dirname}/backup/hrrr.nc")
+    hrtime, frames = hrrr_fetch(htime, thds, delay)
+    ds = grib_dataset(frames)
     
-    remove = [f"rm ../{datdir}/{dirname}/backup/hrrr/*.nc"]
-    subprocess.run(remove, shell=True)
+    windows = cut_windows(grids, lambda grid: hrrr_steps(remap(ds, grid), hrtime, htime))
+    save_windows([partial(out.to_netcdf, f"../{datdir}/{gdir}/backup/hrrr.nc") for gdir, grid, out in windows])
 
 
-def goes(dirname, gtime, delay):
+def goes_keys(gtime, delay):
     
     gettime = gtime - timedelta(minutes=delay[2])
     i = 0
-    while i < 13:
-        minute_str = gettime.strftime("%M").zfill(2)
+    keys = []
+    limit = gettime - timedelta(hours=3)
+    while i < 13 and gettime > limit:
         hour_str = gettime.strftime("%H").zfill(2)
         doy_str = str(gettime.timetuple().tm_yday).zfill(3)
         year_str = gettime.strftime("%Y").zfill(4)
-        files_in_directory = list_files_s3("noaa-goes16", f"ABI-L2-MCMIPC/{year_str}/{doy_str}/{hour_str}/")
-        matching_files = [file for file in files_in_directory if fnmatch.fnmatch(file, f"*_G16_s???????{hour_str}{minute_str}*.nc")]
-
-        if matching_files:
-            file_down = matching_files[0]
-            file_newname = gettime.strftime("%Y%m%d-%H%M.nc")
-            s3.download_file("noaa-goes16", file_down, f"../{datdir}/{dirname}/backup/goes/{file_newname}")
-            print(f"GOES-16 {file_newname} downloaded successfully.")
+        file_down = find_key("noaa-goes16", f"ABI-L2-MCMIPC/{year_str}/{doy_str}/{hour_str}/", gettime)
+
+        if file_down:
+            keys.append((gettime, file_down))
             i += 1
         gettime -= timedelta(minutes=1)
-    
-    file_paths = glob.glob(f"../{datdir}/{dirname}/backup/goes/*.nc")
-    for file_path in file_paths:
-        fnext = os.path.basename(file_path)
-        fnnext = os.path.splitext(fnext)[0]
-        cdo.selname('CMI_C02,CMI_C07,CMI_C13', input=f"{file_path}", options='-f nc4', output=f"../{datdir}/{dirname}/backup/goes/{fnnext}_tmp1.nc")
-        for band in ['CMI_C02', 'CMI_C07', 'CMI_C13']:
-            gdal = [
-                "bash", "-c",
-                f"gdalwarp -q -s_srs \"+proj=geos +h=35786023.0 +a=6378137.0 +b=6356752.31414 +f=0.0033528106647475126 +lon_0=-75.0 +sweep=x +no_defs\" -t_srs EPSG:4326 -r near NETCDF:\"../{datdir}/{dirname}/backup/goes/{fnnext}_tmp1.nc\":{band} ../{datdir}/{dirname}/backup/goes/{fnnext}_{band}.nc"
-            ]
-            subprocess.run(gdal)
-            cdo.chname(f"Band1,{band}", input=f"../{datdir}/{dirname}/backup/goes/{fnnext}_{band}.nc", output=f"../{datdir}/{dirname}/backup/goes/{fnnext}_{band}_r.nc")
-        cdo.merge(input=f"../{datdir}/{dirname}/backup/goes/{fnnext}_CMI_C02_r.nc ../{datdir}/{dirname}/backup/goes/{fnnext}_CMI_C07_r.nc ../{datdir}/{dirname}/backup/goes/{fnnext}_CMI_C13_r.nc", output=f"../{datdir}/{dirname}/backup/goes/{fnnext}_tmp2.nc")
-    
-    files = glob.glob(f"../{datdir}/{dirname}/backup/goes/*_tmp2.nc")
-    files = sorted(files)
-    for file in files:
-        gettime = gettime + timedelta(minutes=5)
-        newname = gettime.strftime("%Y%m%d_%H%M_tmp3")
-        cdo.settaxis(gettime.strftime("%Y-%m-%d,%H:%M:00,5min"), input=f"{file}", options='-f nc4 -r', output=f"../{datdir}/{dirname}/backup/goes/{newname}.nc")
-    
-    gtime -= timedelta(hours=1)
-    time_str = gtime.strftime("%Y-%m-%d,%H:%M:00,5min")
-    cdo.remapnn('./mygrid', input=f"-settaxis,{time_str} -setmisstoc,0 -mergetime ../{datdir}/{dirname}/backup/goes/*_tmp3.nc", options="-b F32 -f nc4 -r", output=f"../{datdir}/{dirname}/backup/goes.nc")
-    
-    remove = [f"rm ../{datdir}/{dirname}/backup/goes/*_tmp?.nc"]
-    subprocess.run(remove, shell=True)
+    if i < 13: raise RuntimeError(f"only {i} of 13 GOES-16 scans found before {gtime}")
+    return keys, gettime
+
+
+def prefetch_goes(gtime, delay):
+    # scans are read as byte ranges cut to the sample windows, so there is nothing to pull ahead but the listing
+    goes_keys(gtime, delay)
+
+
+def goes_steps(grid, cube, gtime):
+    # a window's (time, band, y, x) scans, oldest first, labelled from an hour before gtime
+    ds = grid_dataset(grid)
+    ds.coords["time"] = ("time", pd.date_range(gtime - timedelta(hours=1), periods=len(cube), freq="5min"))
+    cube = np.nan_to_num(cube, nan=0.0)
+    for b, band in enumerate(goes_bands): ds[band] = (("time", "lat", "lon"), cube[:, b])
+    return ds
+
+
+def goes(dirname, gtime, delay, grids):
+    
+    keys, gettime = goes_keys(gtime, delay)
+    # a tiled set reads every scan once for the cover and slices the tiles out of it
+    cover = cover_grid([grid for gdir, grid in grids])
+    cubes = read_scans("noaa-goes16", [key for stamp, key in sorted(keys)], [cover] if cover else [grid for gdir, grid in grids])
+    if cover:
+        whole = goes_steps(cover, cubes[0], gtime)
+        windows = [(gdir, cut_window(whole, cover, grid)) for gdir, grid in grids]
+    else: windows = [(gdir, goes_steps(grid, cube, gtime)) for (gdir, grid), cube in zip(grids, cubes)]
+    save_windows([partial(out.to_netcdf, f"../{datdir}/{gdir}/backup/goes.nc") for gdir, out in windows])
 
 
-__all__ = ['mrms', 'mfilerdir_hrrr', 'hrrr', 'goes']
\ No newline at end of file
+__all__ = ['write_threads', 'save_windows', 'convert_mrms', 'mrms_keys', 'prefetch_mrms', 'mrms_steps', 'mrms', 'hrrr_cycle', 'hrrr_fetch', 'prefetch_hrrr', 'hrrr_steps', 'hrrr', 'goes_keys', 'prefetch_goes', 'goes_steps', 'goes']
\ No newline at end of file
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+import numpy as np
+import xarray as xr
+from scipy.spatial import cKDTree
+from . import cachedir
+from utils.cache_utils import cache_lock
+
+# every window data.py can draw is a strided slice of this 0.01 degree CONUS lattice
+lattice = {'xfirst': -116.1, 'yfirst': 25.0, 'inc': 0.01, 'xsize': 4500, 'ysize': 2500}
+regriddir = os.path.join('..', cachedir, 'regrid')
+_indexes = {}
+_lattices = {}
+_fields = {}
+_lattice_lock = threading.RLock()
+
+
+def grid_text(grid):
+    return f"""gridtype = {grid.get('gridtype', 'lonlat')}
+                xsize    = {grid['xsize']}
+                ysize    = {grid['ysize']}
+                xfirst   = {grid['xfirst']}
+                xinc     = {grid['xinc']}
+                yfirst   = {grid['yfirst']}
+                yinc     = {grid['yinc']}
+                """
+
+
+def grid_coords(grid):
+    lat = np.round(grid["yfirst"] + np.arange(grid["ysize"]) * grid["yinc"], 6)
+    lon = np.round(grid["xfirst"] + np.arange(grid["xsize"]) * grid["xinc"], 6)
+    return lat, lon
+
+
+def source_coords(ds):
+    # wgrib2 writes latitude/longitude (0..360), cdo and gdal write lat/lon
+    lat = next(ds[name] for name in ["lat", "latitude"] if name in ds.variables)
+    lon = next(ds[name] for name in ["lon", "longitude"] if name in ds.variables)
+    lonv = np.asarray(lon.values, dtype=np.float64)
+    lonv = np.where(lonv >= 180, lonv - 360, lonv)
+    if lat.ndim == 1: dims = (lat.dims[0], lon.dims[0])
+    else: dims = lat.dims
+    return np.asarray(lat.values, dtype=np.float64), lonv, dims
+
+
+def _axis_index(axis, points):
+    order = np.argsort(axis)
+    sorted_axis = axis[order]
+    j = np.clip(np.searchsorted(sorted_axis, points), 1, len(sorted_axis) - 1)
+    j = np.where(points - sorted_axis[j-1] <= sorted_axis[j] - points, j - 1, j)
+    half = np.abs(np.diff(sorted_axis)).max() / 2
+    valid = (points >= sorted_axis[0] - half) & (points <= sorted_axis[-1] + half)
+    return order[j], valid
+
+
+def _xyz(lat, lon):
+    rlat = np.deg2rad(lat)
+    rlon = np.deg2rad(lon)
+    return np.stack([np.cos(rlat)*np.cos(rlon), np.cos(rlat)*np.sin(rlon), np.sin(rlat)], axis=-1)
+
+
+def nn_index(lat, lon, tlat, tlon):
+    # nearest source (row, col) for every target point, with points off the source grid masked like REMAP_EXTRAPOLATE=off
+    if lat.ndim == 1:
+        iy, vy = _axis_index(lat, tlat)
+        ix, vx = _axis_index(lon, tlon)
+        iy, ix = np.broadcast_arrays(iy[:, None], ix[None, :])
+        valid = vy[:, None] & vx[None, :]
+        return iy.copy(), ix.copy(), valid
+    xyz = _xyz(lat, lon)
+    spacing = np.linalg.norm(xyz[1:, 1:] - xyz[:-1, :-1], axis=-1).max()
+    tree = cKDTree(xyz.reshape(-1, 3))
+    iy = np.empty((len(tlat), len(tlon)), dtype=np.int32)
+    ix = np.empty((len(tlat), len(tlon)), dtype=np.int32)
+    valid = np.empty((len(tlat), len(tlon)), dtype=bool)
+    for r in range(0, len(tlat), 250):
+        glat, glon = np.meshgrid(tlat[r:r+250], tlon, indexing="ij")
+        dist, flat = tree.query(_xyz(glat, glon))
+        iy[r:r+250], ix[r:r+250] = np.unravel_index(flat, lat.shape)
+        valid[r:r+250] = dist <= spacing
+    return iy, ix, valid
+
+
+def source_key(lat, lon):
+    digest = hashlib.sha1(lat.tobytes() + lon.tobytes()).hexdigest()
+    return f"{lat.ndim}d_{'x'.join(str(n) for n in lat.shape)}_{digest[:16]}"
+
+
+def lattice_window(grid):
+    step = lattice['inc']
+    offsets = [grid['xinc']/step, grid['yinc']/step, (grid['xfirst']-lattice['xfirst'])/step, (grid['yfirst']-lattice['yfirst'])/step]
+    if any(abs(value - round(value)) > 1e-6 for value in offsets): return None
+    sx, sy, i0, j0 = [round(value) for value in offsets]
+    i1 = i0 + sx*(grid['xsize']-1)
+    j1 = j0 + sy*(grid['ysize']-1)
+    if min(sx, sy) < 1 or min(i0, j0) < 0 or i1 >= lattice['xsize'] or j1 >= lattice['ysize']: return None
+    return slice(j0, j1+1, sy), slice(i0, i1+1, sx)
+
+
+def lattice_grid():
+    return {'gridtype': 'lonlat', 'xfirst': lattice['xfirst'], 'yfirst': lattice['yfirst'], 'xinc': lattice['inc'], 'yinc': lattice['inc'], 'xsize': lattice['xsize'], 'ysize': lattice['ysize']}
+
+
+def lattice_cache(key, build):
+    # CONUS-wide (iy, ix, valid) lookup built once by build(tlat, tlon) and memory-mapped by every later window and process
+    with _lattice_lock: return _lattice_cache(key, build)
+
+
+def _lattice_cache(key, build):
+    if key in _lattices: return _lattices[key]
+    path = os.path.join(regriddir, key)
+    # one process builds a missing lookup while the others wait on the lock, then find it there
+    if not os.path.exists(path):
+        with cache_lock(f"regrid_{key}"):
+            if not os.path.exists(path):
+                tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                os.makedirs(tmp, exist_ok=True)
+                tlat, tlon = grid_coords(lattice_grid())
+                iy, ix, valid = build(tlat, tlon)
+                np.save(os.path.join(tmp, 'iy.npy'), iy.astype(np.int32))
+                np.save(os.path.join(tmp, 'ix.npy'), ix.astype(np.int32))
+                np.save(os.path.join(tmp, 'valid.npy'), valid)
+                try: os.rename(tmp, path)
+                except OSError: shutil.rmtree(tmp, ignore_errors=True)
+    weights = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in ['iy', 'ix', 'valid']}
+    _lattices[key] = (weights['iy'], weights['ix'], weights['valid'])
+    return _lattices[key]
+
+
+def lattice_fields(key, build):
+    # static (lat, lon) fields remapped onto the whole lattice once by build(grid) and memory-mapped as {name: (array, attrs)}
+    with _lattice_lock:
+        if key in _fields: return _fields[key]
+        path = os.path.join(regriddir, key)
+        if not os.path.exists(path):
+            with cache_lock(f"regrid_{key}"):
+                if not os.path.exists(path):
+                    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    os.makedirs(tmp, exist_ok=True)
+                    ds = build(lattice_grid())
+                    for name, var in ds.data_vars.items(): np.save(os.path.join(tmp, f"{name}.npy"), np.asarray(var.values, dtype=np.float32))
+                    with open(os.path.join(tmp, 'attrs.json'), 'w') as file: json.dump({name: {k: v.item() if hasattr(v, 'item') else v for k, v in var.attrs.items()} for name, var in ds.data_vars.items()}, file)
+                    try: os.rename(tmp, path)
+                    except OSError: shutil.rmtree(tmp, ignore_errors=True)
+        with open(os.path.join(path, 'attrs.json'), 'r') as file: attrs = json.load(file)
+        _fields[key] = {name: (np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r'), attrs[name]) for name in attrs}
+        return _fields[key]
+
+
+def reset_lattices():
+    # drops this process's open lookups, so the next window reads (or builds) them from regriddir again
+    with _lattice_lock:
+        _indexes.clear()
+        _lattices.clear()
+        _fields.clear()
+
+
+def lattice_index(lat, lon):
+    return lattice_cache(source_key(lat, lon), lambda tlat, tlon: nn_index(lat, lon, tlat, tlon))
+
+
+def grid_index(ds, grid):
+    lat, lon, dims = source_coords(ds)
+    window = lattice_window(grid)
+    if window is not None:
+        iy, ix, valid = lattice_index(lat, lon)
+        return (np.asarray(iy[window]), np.asarray(ix[window]), np.asarray(valid[window])), dims
+    key = (source_key(lat, lon), tuple(sorted(grid.items())))
+    if key not in _indexes:
+        tlat, tlon = grid_coords(grid)
+        _indexes[key] = nn_index(lat, lon, tlat, tlon)
+    return _indexes[key], dims
+
+
+def grid_dataset(grid):
+    tlat, tlon = grid_coords(grid)
+    out = xr.Dataset(coords={"lat": ("lat", tlat), "lon": ("lon", tlon)})
+    out["lat"].attrs = {"standard_name": "latitude", "long_name": "latitude", "units": "degrees_north", "axis": "Y"}
+    out["lon"].attrs = {"standard_name": "longitude", "long_name": "longitude", "units": "degrees_east", "axis": "X"}
+    return out
+
+
+def remap(ds, grid, dtype=np.float32):
+    (iy, ix, valid), (ydim, xdim) = grid_index(ds, grid)
+    if valid.any(): y0, y1, x0, x1 = iy[valid].min(), iy[valid].max() + 1, ix[valid].min(), ix[valid].max() + 1
+    else: y0, y1, x0, x1 = 0, 1, 0, 1
+    riy = np.clip(iy - y0, 0, y1 - y0 - 1)
+    rix = np.clip(ix - x0, 0, x1 - x0 - 1)
+    out = grid_dataset(grid)
+    for name, var in ds.data_vars.items():
+        if var.dims[-2:] != (ydim, xdim): continue
+        # one bounding-box read for the whole time stack, then a single fancy-index gather
+        block = np.asarray(var.isel({ydim: slice(y0, y1), xdim: slice(x0, x1)}).values, dtype=dtype)
+        data = np.where(valid, block[..., riy, rix], np.nan).astype(dtype)
+        out[name] = (var.dims[:-2] + ("lat", "lon"), data, var.attrs)
+        for dim in var.dims[:-2]:
+            if dim in ds.coords: out.coords[dim] = ds.coords[dim]
+    out.attrs = ds.attrs
+    return out
+
+
+def tile_grids(template, stride, xrange=(-116.1, -76.1), yrange=(25.0, 45.0)):
+    # (row, col, grid) for template-sized windows every stride pixels over the origins data.py draws from,
+    # the last row and column pulled flush with the far edge so every pixel is covered
+    sx, sy = round(template['xinc']/lattice['inc']), round(template['yinc']/lattice['inc'])
+    def origins(lo, hi, first, step):
+        i0, i1 = round((lo-first)/lattice['inc']), round((hi-first)/lattice['inc'])
+        found = list(range(i0, i1+1, step))
+        if found[-1] != i1: found.append(i1)
+        return found
+    tiles = []
+    for r, j0 in enumerate(origins(*yrange, lattice['yfirst'], sy*stride)):
+        for c, i0 in enumerate(origins(*xrange, lattice['xfirst'], sx*stride)):
+            tiles.append((r, c, dict(template, xfirst=round(lattice['xfirst'] + i0*lattice['inc'], 2), yfirst=round(lattice['yfirst'] + j0*lattice['inc'], 2))))
+    return tiles
+
+
+def cover_grid(grids):
+    # one grid spanning every window, if they share a spacing, sit on each other's pixels and overlap enough
+    # that remapping the cover once is no more work than remapping each window
+    first = grids[0]
+    if len(grids) < 2 or any(grid['xinc'] != first['xinc'] or grid['yinc'] != first['yinc'] for grid in grids): return None
+    offsets = [((grid['xfirst']-first['xfirst'])/first['xinc'], (grid['yfirst']-first['yfirst'])/first['yinc']) for grid in grids]
+    if any(abs(value - round(value)) > 1e-6 for pair in offsets for value in pair): return None
+    i0 = min(round(ox) for ox, oy in offsets)
+    j0 = min(round(oy) for ox, oy in offsets)
+    i1 = max(round(ox) + grid['xsize'] for (ox, oy), grid in zip(offsets, grids))
+    j1 = max(round(oy) + grid['ysize'] for (ox, oy), grid in zip(offsets, grids))
+    if (i1-i0) * (j1-j0) > sum(grid['xsize'] * grid['ysize'] for grid in grids): return None
+    return dict(first, xfirst=round(first['xfirst'] + i0*first['xinc'], 6), yfirst=round(first['yfirst'] + j0*first['yinc'], 6), xsize=i1-i0, ysize=j1-j0)
+
+
+def cut_window(whole, cover, grid):
+    i0 = round((grid['xfirst']-cover['xfirst'])/cover['xinc'])
+    j0 = round((grid['yfirst']-cover['yfirst'])/cover['yinc'])
+    out = whole.isel(lat=slice(j0, j0+grid['ysize']), lon=slice(i0, i0+grid['xsize']))
+    lat, lon = grid_coords(grid)
+    return out.assign_coords(lat=('lat', lat, whole['lat'].attrs), lon=('lon', lon, whole['lon'].attrs))
+
+
+def cut_windows(samples, build):
+    # (sample directory, grid, build(grid)) for every window; windows that tile an area are built once on their cover
+    # and sliced from it, which gives the same arrays for any build that works point by point
+    cover = cover_grid([grid for gdir, grid in samples])
+    if cover is None: return [(gdir, grid, build(grid)) for gdir, grid in samples]
+    whole = build(cover)
+    return [(gdir, grid, cut_window(whole, cover, grid)) for gdir, grid in samples]
+
+
+__all__ = ['grid_text', 'grid_coords', 'source_coords', 'nn_index', 'source_key', 'lattice_window', 'lattice_grid', 'regriddir', 'lattice_cache', 'lattice_fields', 'reset_lattices', 'lattice_index', 'grid_index', 'grid_dataset', 'remap', 'tile_grids', 'cover_grid', 'cut_window', 'cut_windows']
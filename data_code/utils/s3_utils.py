@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import re
+import json
+import time
+import bisect
+import shutil
+import asyncio
+import hashlib
+import threading
+import boto3
+from botocore import UNSIGNED
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from utils.cache_utils import cache_get, cache_put, cache_place
+from utils.metrics_utils import count
+
+# listings live next to the other per-run files and are shared by every worker process
+idxdir = '../data_info/s3index'
+idxttl = 900
+_listings = {}
+_indexes = {}
+# every request shares one pooled client per process; pool_size bounds the connections it keeps open
+fetch_threads = 8
+pool_size = 64
+_pooled = {}
+_pool_lock = threading.Lock()
+_shared = {}
+# requests in flight per bucket, and the size above which objects are read as concurrent ranges
+bucket_limits = {'noaa-mrms-pds': 32, 'noaa-goes16': 16, 'noaa-hrrr-bdp-pds': 16}
+bucket_default = 16
+part_size = 8 * 1024**2
+# a directory-backed stand-in replaces S3 for every call when set (or when S3_LOCAL_ROOT is)
+_local = [None]
+_stamps = [
+    (re.compile(r'_(\d{8}-\d{6})\.'), '%Y%m%d-%H%M%S'),
+    (re.compile(r'_s(\d{13})\d?_'), '%Y%j%H%M%S'),
+]
+
+
+def key_time(key):
+    name = os.path.basename(key)
+    for pattern, fmt in _stamps:
+        found = pattern.search(name)
+        if found: return datetime.strptime(found.group(1), fmt)
+    return None
+
+
+def _index_path(bucket, prefix):
+    local = _local[0].root if _local[0] is not None else ''
+    digest = hashlib.sha1(f"{local}{bucket}/{prefix}".encode()).hexdigest()
+    return os.path.join(idxdir, f"{digest}.json")
+
+
+def _read_index(bucket, prefix):
+    try:
+        with open(_index_path(bucket, prefix), 'r') as file: listing = json.load(file)
+    except: return None
+    if time.time() - listing['time'] > idxttl: return None
+    return listing
+
+
+def _write_index(bucket, prefix, listing):
+    os.makedirs(idxdir, exist_ok=True)
+    path = _index_path(bucket, prefix)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as file: json.dump(listing, file)
+    os.replace(tmp, path)
+
+
+def list_keys(bucket, prefix, refresh=False):
+    # refresh skips both memo layers, for callers polling a prefix that is still filling
+    listing = None if refresh else _listings.get((bucket, prefix))
+    if not refresh and (listing is None or time.time() - listing['time'] > idxttl):
+        listing = _read_index(bucket, prefix)
+    if listing is None:
+        keys = []
+        paginator = s3_client().get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            count('s3_calls', bucket=bucket, op='list')
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        listing = {'bucket': bucket, 'prefix': prefix, 'time': time.time(), 'keys': keys}
+        _write_index(bucket, prefix, listing)
+    _listings[(bucket, prefix)] = listing
+    return listing['keys']
+
+
+def listings():
+    # every (bucket, prefix) listed in this process so far, with its keys
+    return {pair: listing['keys'] for pair, listing in _listings.items()}
+
+
+def key_index(bucket, prefix):
+    keys = list_keys(bucket, prefix)
+    index = _indexes.get((bucket, prefix))
+    if index is None or index[0] is not keys:
+        pairs = sorted((stamp, key) for key in keys if (stamp := key_time(key)) is not None)
+        index = (keys, [stamp for stamp, key in pairs], [key for stamp, key in pairs])
+        _indexes[(bucket, prefix)] = index
+    return index[1], index[2]
+
+
+def find_key(bucket, prefix, start, end=None):
+    if end is None: end = start + timedelta(minutes=1)
+    stamps, keys = key_index(bucket, prefix)
+    i = bisect.bisect_left(stamps, start)
+    if i < len(stamps) and stamps[i] < end: return keys[i]
+    return None
+
+
+def pooled_s3():
+    with _pool_lock:
+        client = _pooled.get(os.getpid())
+        if client is None:
+            client = boto3.client('s3', config=Config(signature_version=UNSIGNED, max_pool_connections=pool_size, retries={'max_attempts': 5, 'mode': 'adaptive'}))
+            _pooled.clear()
+            _pooled[os.getpid()] = client
+        return client
+
+
+class LocalS3:
+    # the part of the boto3 client this repo uses, served from root/<bucket>/<key>
+    def __init__(self, root):
+        self.root = root
+        self.calls = 0
+        self.bytes = 0
+    
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+    
+    def _missing(self, bucket, key):
+        return ClientError({'Error': {'Code': 'NoSuchKey', 'Message': f"{bucket}/{key}"}}, 'GetObject')
+    
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, MaxKeys=1000):
+        self.calls += 1
+        base = os.path.join(self.root, Bucket)
+        folder = os.path.join(base, os.path.dirname(Prefix))
+        keys = []
+        for root, dirs, files in os.walk(folder):
+            for file in files:
+                key = os.path.relpath(os.path.join(root, file), base).replace(os.sep, '/')
+                if key.startswith(Prefix) and not key.endswith('.tmp'): keys.append(key)
+        keys.sort()
+        start = int(ContinuationToken or 0)
+        page = {'Contents': [{'Key': key, 'Size': os.path.getsize(os.path.join(base, key))} for key in keys[start:start+MaxKeys]], 'KeyCount': len(keys[start:start+MaxKeys])}
+        if start + MaxKeys < len(keys): page.update(IsTruncated=True, NextContinuationToken=str(start + MaxKeys))
+        else: page['IsTruncated'] = False
+        return page
+    
+    def get_paginator(self, name):
+        client = self
+        class Paginator:
+            def paginate(self, Bucket, Prefix=''):
+                token = None
+                while True:
+                    page = client.list_objects_v2(Bucket=Bucket, Prefix=Prefix, ContinuationToken=token)
+                    yield page
+                    if not page['IsTruncated']: return
+                    token = page['NextContinuationToken']
+        return Paginator()
+    
+    def head_object(self, Bucket, Key):
+        self.calls += 1
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path): raise self._missing(Bucket, Key)
+        return {'ContentLength': os.path.getsize(path)}
+    
+    def get_object(self, Bucket, Key, Range=None):
+        self.calls += 1
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path): raise self._missing(Bucket, Key)
+        with open(path, 'rb') as file:
+            if Range is None: body = file.read()
+            else:
+                start, end = Range.split('=')[1].split('-')
+                file.seek(int(start))
+                body = file.read(int(end) - int(start) + 1)
+        self.bytes += len(body)
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body)}
+    
+    def download_file(self, Bucket, Key, Filename):
+        self.calls += 1
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path): raise self._missing(Bucket, Key)
+        shutil.copyfile(path, Filename)
+        self.bytes += os.path.getsize(path)
+    
+    def put_object(self, Bucket, Key, Body):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", 'wb') as file: file.write(Body if isinstance(Body, bytes) else Body.read())
+        os.replace(f"{path}.tmp", path)
+        return {}
+
+
+def use_local(root):
+    # None switches back to the real buckets; listings are dropped so nothing leaks between the two
+    _local[0] = LocalS3(root) if root else None
+    _listings.clear()
+    _indexes.clear()
+    return _local[0]
+
+
+def s3_client():
+    if _local[0] is not None: return _local[0]
+    return pooled_s3()
+
+
+def read_range(bucket, key, start, end, client=None):
+    # bytes [start, end) of an object
+    client = client or s3_client()
+    body = client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end-1}")['Body'].read()
+    count('s3_calls', bucket=bucket, op='get')
+    count('s3_bytes', len(body), bucket=bucket)
+    return body
+
+
+class AsyncS3:
+    # asyncio front end over the pooled client: blocking calls run on a shared thread pool, gated per bucket
+    def __init__(self, client=None, threads=pool_size, limits=None):
+        self.fixed = client
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.limits = dict(bucket_limits, **(limits or {}))
+        self.gates = {}
+    
+    @property
+    def client(self):
+        # resolved per call, so use_local switches a long-lived instance too
+        return self.fixed or s3_client()
+    
+    def _gate(self, bucket):
+        if bucket not in self.gates: self.gates[bucket] = asyncio.Semaphore(self.limits.get(bucket, bucket_default))
+        return self.gates[bucket]
+    
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+    
+    async def call(self, bucket, func, *args):
+        async with self._gate(bucket): return await self.run(func, *args)
+    
+    async def list(self, bucket, prefix):
+        return await self.call(bucket, list_keys, bucket, prefix)
+    
+    async def size(self, bucket, key):
+        count('s3_calls', bucket=bucket, op='head')
+        return (await self.call(bucket, lambda: self.client.head_object(Bucket=bucket, Key=key)))['ContentLength']
+    
+    async def get(self, bucket, key, start=None, end=None):
+        if start is None:
+            body = await self.call(bucket, lambda: self.client.get_object(Bucket=bucket, Key=key)['Body'].read())
+            count('s3_calls', bucket=bucket, op='get')
+            count('s3_bytes', len(body), bucket=bucket)
+            return body
+        return await self.call(bucket, read_range, bucket, key, start, end, self.client)
+    
+    async def download(self, bucket, key, path):
+        # small objects in one request, large ones as concurrent part_size ranges written in place
+        size = await self.size(bucket, key)
+        if size <= part_size:
+            body = await self.get(bucket, key)
+            with open(path, 'wb') as file: file.write(body)
+            return path
+        with open(path, 'wb') as file:
+            file.truncate(size)
+            async def part(start):
+                body = await self.get(bucket, key, start, min(start + part_size, size))
+                os.pwrite(file.fileno(), body, start)
+            await asyncio.gather(*(part(start) for start in range(0, size, part_size)))
+        return path
+    
+    async def fetch(self, bucket, key, dest=None):
+        # a cache hit costs a link, a miss lands in the cache first
+        path = cache_get(bucket, key)
+        if path is None:
+            tmp = os.path.join(os.path.dirname(os.path.abspath(dest)) if dest else '.', f".{hashlib.sha1(key.encode()).hexdigest()}.{os.getpid()}.{threading.get_ident()}.part")
+            try:
+                await self.download(bucket, key, tmp)
+                path = cache_put(bucket, key, tmp)
+            finally:
+                if os.path.exists(tmp): os.remove(tmp)
+        if dest is None: return path
+        return cache_place(path, dest)
+    
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+def shared_async():
+    # one AsyncS3 and one event loop per process, the loop on a thread of its own, so bucket_limits hold across every caller
+    with _pool_lock:
+        found = _shared.get(os.getpid())
+        if found is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            found = (AsyncS3(), loop)
+            _shared.clear()
+            _shared[os.getpid()] = found
+        return found
+
+
+def run_async(job):
+    # job takes an AsyncS3 and returns a coroutine; used from the synchronous pipeline stages, from any thread
+    aio, loop = shared_async()
+    return asyncio.run_coroutine_threadsafe(job(aio), loop).result()
+
+
+async def bounded(limit, coros):
+    gate = asyncio.Semaphore(max(1, limit))
+    async def one(coro):
+        async with gate: return await coro
+    return await asyncio.gather(*(one(coro) for coro in coros))
+
+
+def list_many(pairs, threads=fetch_threads):
+    # several (bucket, prefix) listings at once; each lands in the same memo list_keys reads
+    return run_async(lambda aio: bounded(threads, [aio.list(bucket, prefix) for bucket, prefix in pairs]))
+
+
+def fetch_frames(bucket, jobs, handler=None, threads=fetch_threads):
+    # jobs are (key, path) pairs; each frame goes to handler as soon as it lands so downloads and conversion overlap
+    async def work(aio, job):
+        key, path = job
+        await aio.fetch(bucket, key, path)
+        if handler is None: return path
+        return await aio.run(handler, path)
+    if not jobs: return []
+    return run_async(lambda aio: bounded(threads, [work(aio, job) for job in jobs]))
+
+
+def warm_frames(bucket, keys, threads=fetch_threads):
+    # pulls objects into the frame cache only, so a later decode stage never waits on the network
+    if not keys: return []
+    return run_async(lambda aio: bounded(threads, [aio.fetch(bucket, key) for key in keys]))
+
+
+if os.environ.get('S3_LOCAL_ROOT'): use_local(os.environ['S3_LOCAL_ROOT'])
+
+
+__all__ = ['key_time', 'list_keys', 'listings', 'key_index', 'find_key', 'pooled_s3', 'LocalS3', 'use_local', 's3_client', 'read_range', 'AsyncS3', 'shared_async', 'run_async', 'bounded', 'list_many', 'fetch_frames', 'warm_frames']
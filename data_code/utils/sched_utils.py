@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import queue
+import signal
+import itertools
+import traceback
+import multiprocessing
+from utils.metrics_utils import TaskError, measured, reason, track_subprocesses, tracking
+
+# default number of tasks of each stage allowed in flight at once
+stage_limits = {'fetch': 8, 'decode': 4, 'merge': 4, 'validate': 2, 'target': 2, 'store': 1}
+_started = [None]
+
+
+def _init(started, tracked):
+    # workers start from a clean forkserver process, so the parent's subprocess counting is turned on again here
+    _started[0] = started
+    if tracked: track_subprocesses()
+
+
+def _run(token, func, args, kwargs):
+    # runs in the worker: the scheduler's clock for this attempt starts here, not when it was queued,
+    # and the attempt's own duration comes back with its result (or its error)
+    started = time.time()
+    _started[0].put((token, os.getpid(), started))
+    try: result, counters = measured(func, *args, **kwargs)
+    except TaskError as e:
+        e.seconds = time.time() - started
+        raise
+    return result, counters, time.time() - started
+
+
+class Task:
+    def __init__(self, name, stage, func, args=(), kwargs=None, deps=(), check=None, after=None):
+        self.name = name
+        self.stage = stage
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.deps = list(deps)
+        self.check = check
+        self.after = after
+        self.tries = 0
+        self.status = 'waiting'
+        self.not_before = 0
+        self.started = None
+        self.pid = None
+        self.error = None
+        self.result = None
+
+
+class Scheduler:
+    # runs a growing task graph on one persistent process pool, with per-stage limits and per-task retries;
+    # a worker that overruns the timeout is killed and the pool starts a replacement in its place;
+    # workers come from a forkserver, never from this process, whose S3 loop and thread pools may hold locks
+    def __init__(self, workers, limits=None, retries=3, backoff=5, timeout=500, log=None, on_done=None, metrics=None):
+        context = multiprocessing.get_context('forkserver')
+        self.started = context.Queue()
+        self.pool = context.Pool(workers, initializer=_init, initargs=(self.started, tracking()))
+        self.results = queue.Queue()
+        self.tokens = itertools.count()
+        self.limits = dict(stage_limits, **(limits or {}))
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.log = log
+        self.on_done = on_done
+        self.metrics = metrics
+        self.tasks = {}
+        self.running = {}
+        self.stuck = {}
+
+    def add(self, name, stage, func, args=(), kwargs=None, deps=(), check=None, after=None):
+        self.tasks[name] = Task(name, stage, func, args, kwargs, deps, check, after)
+        return name
+
+    def pending(self):
+        return sum(1 for task in self.tasks.values() if task.status in ['waiting', 'running'])
+
+    def _note(self, message):
+        print("\n" + message + "\n")
+        if self.log:
+            with open(self.log, "a") as file: file.write(message + "\n")
+
+    def _ready(self, task):
+        if task.status != 'waiting' or time.time() < task.not_before: return False
+        if any(self.tasks[dep].status != 'done' for dep in task.deps if dep in self.tasks): return False
+        # a killed worker still holds its slot until it has actually exited
+        busy = sum(1 for other in self.running.values() if other.stage == task.stage) + sum(1 for stage in self.stuck.values() if stage == task.stage)
+        return busy < self.limits.get(task.stage, 1)
+
+    def _record(self, task, status, seconds, counters=(), error=None):
+        if self.metrics is not None: self.metrics.record(task, status, seconds, counters, error)
+
+    def _fail(self, task, reason, seconds, counters=()):
+        task.error = reason
+        self._record(task, 'retry' if task.tries <= self.retries else 'failed', seconds, counters, reason)
+        if task.tries <= self.retries:
+            task.status = 'waiting'
+            task.not_before = time.time() + self.backoff * 2**(task.tries-1)
+            self._note(f"{task.name} retry #{task.tries} ({reason})")
+            return
+        task.status = 'failed'
+        self._note(f"{task.name} failed after {task.tries} attempts ({reason})")
+        # anything downstream of a failed task cannot run
+        stack = [task.name]
+        while stack:
+            failed = stack.pop()
+            for other in self.tasks.values():
+                if other.status == 'waiting' and failed in other.deps:
+                    other.status = 'skipped'
+                    stack.append(other.name)
+
+    def _finish(self, token, ok, value):
+        # results of attempts that were timed out and killed are dropped
+        task = self.running.pop(token, None)
+        if task is None: return
+        counters = ()
+        seconds = getattr(value, 'seconds', 0.0)
+        try:
+            if not ok: raise value
+            result, counters, seconds = value
+            if task.check is not None and not task.check(): raise RuntimeError("output check failed")
+        except TaskError as e:
+            self._fail(task, e.reason, seconds, e.counters)
+            return
+        except Exception as e:
+            self._fail(task, reason(e), seconds, counters)
+            return
+        task.status = 'done'
+        task.result = result
+        self._record(task, 'done', seconds, counters)
+        try:
+            if self.on_done is not None: self.on_done(task)
+            if task.after is not None: task.after()
+        except: traceback.print_exc()
+
+    def _submit(self):
+        for task in list(self.tasks.values()):
+            if not self._ready(task): continue
+            task.tries += 1
+            task.status = 'running'
+            task.started = None
+            task.pid = None
+            token = next(self.tokens)
+            self.running[token] = task
+            self.pool.apply_async(_run, (token, task.func, task.args, task.kwargs), callback=lambda value, token=token: self.results.put((token, True, value)), error_callback=lambda e, token=token: self.results.put((token, False, e)))
+
+    def _watch(self):
+        while True:
+            try: token, pid, started = self.started.get_nowait()
+            except queue.Empty: break
+            if token in self.running: self.running[token].started, self.running[token].pid = started, pid
+        # a killed worker is reaped by the pool; until then it counts against its stage
+        for pid in list(self.stuck):
+            try: os.kill(pid, 0)
+            except ProcessLookupError: del self.stuck[pid]
+        now = time.time()
+        for token, task in list(self.running.items()):
+            if task.started is None or now - task.started <= self.timeout: continue
+            del self.running[token]
+            try:
+                os.kill(task.pid, signal.SIGKILL)
+                self.stuck[task.pid] = task.stage
+            except ProcessLookupError: pass
+            self._fail(task, f"timed out after {self.timeout} s", now - task.started)
+
+    def pump(self, block=False):
+        self._submit()
+        if not self.running and not self.stuck: return
+        try:
+            self._finish(*self.results.get(timeout=1 if block else 0.001))
+            while True: self._finish(*self.results.get_nowait())
+        except queue.Empty: pass
+        self._watch()
+        self._submit()
+
+    def drain(self):
+        while self.pending() > 0:
+            if not self.running and not any(self._ready(task) for task in self.tasks.values()): time.sleep(0.5)
+            self.pump(block=True)
+        return {name: task.status for name, task in self.tasks.items()}
+
+    def close(self):
+        # a killed attempt never reports back, so the pool is terminated rather than waited on
+        self.pool.terminate()
+        self.pool.join()
+
+
+__all__ = ['stage_limits', 'Task', 'Scheduler']
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+from datetime import timedelta
+from . import cachedir
+from utils.s3_utils import find_key, warm_frames
+from utils.decode_utils import mrms_names, read_grib, grib_dataset
+from utils.regrid_utils import lattice, lattice_index, lattice_window, remap
+
+# origins data.py draws windows from, in degrees
+origins = {'xmin': -116.1, 'xmax': -76.1, 'ymin': 25.0, 'ymax': 45.0}
+screendir = os.path.join('..', cachedir, 'cref')
+_summaries = {}
+
+
+def cref_hour(crtim):
+    crtim += timedelta(hours=1)
+    if crtim.minute >= 30: crtim += timedelta(hours=1)
+    return crtim.replace(minute=0, second=0, microsecond=0)
+
+
+def _sats(mask):
+    # one summed-area table per (row, column) parity, since a 0.02 degree window takes every other lattice point
+    sats = {}
+    for p in range(2):
+        for q in range(2):
+            sub = mask[p::2, q::2].astype(np.int32)
+            sat = np.zeros((sub.shape[0]+1, sub.shape[1]+1), dtype=np.int32)
+            np.cumsum(np.cumsum(sub, axis=0), axis=1, out=sat[1:, 1:])
+            sats[(p, q)] = sat
+    return sats
+
+
+def cref_summary(crtim, ref):
+    hour = cref_hour(crtim)
+    key = (hour, ref)
+    if key in _summaries: return _summaries[key]
+    path = os.path.join(screendir, f"{hour:%Y%m%d%H}_{ref}.npz")
+    if not os.path.exists(path):
+        file_down = find_key("noaa-mrms-pds", f"CONUS/CREF_1HR_MAX_00.50/{hour:%Y%m%d}/", hour)
+        if file_down is None: return None
+        raw = warm_frames("noaa-mrms-pds", [file_down])[0]
+        fields, stamp, lat, lon = read_grib(raw, mrms_names["CREF_1HR_MAX_00.50"])
+        lon = np.where(lon >= 180, lon - 360, lon)
+        iy, ix, valid = lattice_index(lat, lon)
+        cref = fields[mrms_names["CREF_1HR_MAX_00.50"]][np.asarray(iy), np.asarray(ix)]
+        mask = np.asarray(valid) & (cref >= ref)
+        os.makedirs(screendir, exist_ok=True)
+        tmp = f"{path[:-4]}.{os.getpid()}.tmp.npz"
+        np.savez(tmp, mask=np.packbits(mask, axis=1), width=mask.shape[1], key=file_down)
+        os.replace(tmp, path)
+    with np.load(path) as saved:
+        mask = np.unpackbits(saved['mask'], axis=1, count=int(saved['width'])).astype(bool)
+        file_down = str(saved['key'])
+    if len(_summaries) >= 8: _summaries.pop(next(iter(_summaries)))
+    _summaries[key] = {'mask': mask, 'sats': _sats(mask), 'key': file_down, 'ref': ref}
+    return _summaries[key]
+
+
+def window_count(summary, grid):
+    window = lattice_window(grid)
+    if window is None:
+        # off-lattice windows fall back to remapping the cached CREF frame directly
+        name = mrms_names["CREF_1HR_MAX_00.50"]
+        ds = grib_dataset([read_grib(warm_frames("noaa-mrms-pds", [summary['key']])[0], name)])
+        return int((remap(ds, grid)[name] >= summary['ref']).sum())
+    rows, cols = window
+    if rows.step != 2 or cols.step != 2: return int(summary['mask'][rows, cols].sum())
+    sat = summary['sats'][(rows.start % 2, cols.start % 2)]
+    a0, b0 = rows.start // 2, cols.start // 2
+    a1, b1 = a0 + grid['ysize'], b0 + grid['xsize']
+    return int(sat[a1, b1] - sat[a0, b1] - sat[a1, b0] + sat[a0, b0])
+
+
+def passing_origins(summary, num, xsize, ysize):
+    # every lattice origin inside the sampling box whose 0.02 degree window has at least num hits
+    step = lattice['inc']
+    imax = round((origins['xmax'] - lattice['xfirst']) / step)
+    jmin = round((origins['ymin'] - lattice['yfirst']) / step)
+    jmax = round((origins['ymax'] - lattice['yfirst']) / step)
+    imin = round((origins['xmin'] - lattice['xfirst']) / step)
+    found = []
+    for (p, q), sat in summary['sats'].items():
+        counts = sat[ysize:, xsize:] - sat[:-ysize, xsize:] - sat[ysize:, :-xsize] + sat[:-ysize, :-xsize]
+        a, b = np.nonzero(counts >= num)
+        j0, i0 = 2*a + p, 2*b + q
+        keep = (j0 >= jmin) & (j0 <= jmax) & (i0 >= imin) & (i0 <= imax)
+        found.append(np.stack([j0[keep], i0[keep]], axis=1))
+    return np.concatenate(found)
+
+
+def draw_grids(summary, n, num, template, rng=np.random):
+    cells = passing_origins(summary, num, template['xsize'], template['ysize'])
+    if len(cells) == 0: return []
+    picks = cells[rng.choice(len(cells), size=min(n, len(cells)), replace=False)]
+    grids = []
+    for j0, i0 in picks:
+        grid = dict(template)
+        grid['xfirst'] = round(float(lattice['xfirst'] + i0*lattice['inc']), 2)
+        grid['yfirst'] = round(float(lattice['yfirst'] + j0*lattice['inc']), 2)
+        grids.append(grid)
+    return grids
+
+
+__all__ = ['cref_hour', 'cref_summary', 'window_count', 'passing_origins', 'draw_grids']
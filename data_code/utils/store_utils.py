@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import zlib
+import json
+import shutil
+import zarr
+import numpy as np
+import xarray as xr
+from numcodecs import Blosc
+from . import datdir
+from utils.cache_utils import cache_lock
+
+# one chunk holds one sample's full time series of a variable (250x250x13 float32 is ~3 MB raw)
+store_chunks = {'sample': 1, 'step': 13}
+compressor = Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE)
+_stored = {}
+
+
+def store_path(name, shards=1):
+    # samples are spread over shards by a stable hash of their name, so a rerun appends to the same shard
+    if shards <= 1: return os.path.join('..', datdir, 'dataset.zarr')
+    return os.path.join('..', datdir, f"dataset_{zlib.crc32(name.encode()) % shards:02d}.zarr")
+
+
+def store_paths():
+    paths = [os.path.join('..', datdir, item) for item in os.listdir(os.path.join('..', datdir)) if item.startswith('dataset') and item.endswith('.zarr')]
+    return sorted(paths)
+
+
+def sample_record(dirname):
+    # a sample directory's three stores as one dataset with a leading sample dimension
+    base = os.path.join('..', datdir, dirname)
+    ins = xr.open_zarr(f"{base}/inputs.zarr")
+    mrms = xr.open_zarr(f"{base}/mrms.zarr")
+    target = xr.open_zarr(f"{base}/target.zarr")
+    ds = xr.merge([
+        ins.drop_vars('time').rename(time='step'),
+        mrms.drop_vars('time').rename(time='step'),
+        target.drop_vars('time', errors='ignore'),
+    ], compat='override', join='override')
+    ds['target'] = ds['target'].astype(np.int8)
+    lat, lon = ds['lat'].values, ds['lon'].values
+    ds = ds.drop_vars(['lat', 'lon']).rename_dims(lat='y', lon='x')
+    ds['lat'] = ('y', lat)
+    ds['lon'] = ('x', lon)
+    ds['time'] = ('step', ins['time'].values)
+    ds['mrms_time'] = ('step', mrms['time'].values)
+    ds['xfirst'] = round(float(lon[0]), 2)
+    ds['yfirst'] = round(float(lat[0]), 2)
+    ds = ds.expand_dims(sample=np.array([dirname], dtype='U32'))
+    return ds.set_coords(['lat', 'lon', 'time', 'mrms_time', 'xfirst', 'yfirst'])
+
+
+def store_encoding(ds):
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        chunks = tuple(store_chunks.get(dim, size) for dim, size in zip(var.dims, var.shape))
+        encoding[name] = {'chunks': chunks, 'compressors': (compressor, )}
+    return encoding
+
+
+def stored_samples(path):
+    # called under the shard's lock; names are kept with the shard's size, so only samples appended since are read
+    try:
+        with open(os.path.join(path, 'sample', '.zarray'), 'r') as file: size = json.load(file)['shape'][0]
+    except FileNotFoundError:
+        _stored.pop(path, None)
+        return set()
+    known, names = _stored.get(path, (0, set()))
+    if size < known: known, names = 0, set()
+    if size > known: names = names | set(zarr.open_group(path, mode='r')['sample'][known:size].tolist())
+    _stored[path] = (size, names)
+    return names
+
+
+def append_samples(dirnames, shards=1, remove=False):
+    # appends are serialised per shard, since zarr has no concurrent-append safety of its own
+    for dirname in dirnames:
+        path = store_path(dirname, shards)
+        ds = sample_record(dirname).load()
+        with cache_lock(os.path.basename(path)):
+            if dirname in stored_samples(path): pass
+            elif os.path.exists(path): ds.to_zarr(path, append_dim='sample', consolidated=True)
+            else:
+                # the first sample creates the store under a temporary name, so a crash never leaves half a store
+                tmp = f"{path}.{os.getpid()}.tmp"
+                ds.to_zarr(tmp, mode='w', encoding=store_encoding(ds), consolidated=True, zarr_format=2)
+                os.rename(tmp, path)
+        if remove:
+            for prod in ['inputs', 'mrms', 'target']: shutil.rmtree(f"../{datdir}/{dirname}/{prod}.zarr", ignore_errors=True)
+
+
+__all__ = ['store_chunks', 'compressor', 'store_path', 'store_paths', 'sample_record', 'store_encoding', 'stored_samples', 'append_samples']
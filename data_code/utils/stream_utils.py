@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import xarray as xr
+from collections import OrderedDict
+from datetime import timedelta
+from utils.s3_utils import key_time, list_keys, warm_frames
+from utils.decode_utils import mrms_names, read_grib, grib_dataset
+from utils.regrid_utils import remap
+from utils.goes_utils import read_scans
+from utils.model_utils import hrrr_search, hrrr_cycle, mrms_steps, hrrr_steps, goes_steps
+from utils.helper_utils import elev_time
+from utils.metrics_utils import count, reason
+
+# frames kept per product: an hour of GOES scans plus slack, three HRRR cycles,
+# and enough 2-minute MRMS frames to still cover the cycle being verified an hour back
+ring_sizes = {'mrms': 72, 'goes': 16, 'hrrr': 3}
+delaytimes = [3, 55, 5]
+mrms_product = "Reflectivity_-10C_00.50"
+
+
+def floor_time(stamp, minutes=5):
+    return stamp.replace(minute=stamp.minute - stamp.minute % minutes, second=0, microsecond=0)
+
+
+class Ring:
+    # the newest frames of one product, oldest first, each a list with one entry per window
+    def __init__(self, size):
+        self.size = size
+        self.frames = OrderedDict()
+
+    def __contains__(self, stamp):
+        return stamp in self.frames
+
+    def __len__(self):
+        return len(self.frames)
+
+    def push(self, stamp, frame):
+        self.frames[stamp] = frame
+        if len(self.frames) > 1 and stamp < next(reversed(self.frames)):
+            self.frames = OrderedDict(sorted(self.frames.items()))
+        while len(self.frames) > self.size: self.frames.popitem(last=False)
+
+    def oldest(self):
+        return next(iter(self.frames), None)
+
+    def newest(self):
+        return next(reversed(self.frames), None)
+
+    def between(self, start, end):
+        return [(stamp, frame) for stamp, frame in self.frames.items() if start <= stamp < end]
+
+
+class Stream:
+    # polls the buckets for newly arrived objects, keeps every product decoded and cut to the windows in rings,
+    # and assembles a cycle's inputs from the rings instead of downloading anything again
+    def __init__(self, samples, delay=delaytimes, sizes=None, threads=8):
+        self.samples = samples
+        self.grids = [grid for name, grid in samples]
+        self.delay = delay
+        self.threads = threads
+        self.rings = {prod: Ring(size) for prod, size in dict(ring_sizes, **(sizes or {})).items()}
+        self.seen = {prod: set() for prod in self.rings}
+
+    def _new(self, prod, bucket, prefixes, since):
+        # keys older than the ring window can no longer be listed as new, so they are forgotten
+        self.seen[prod] = {key for key in self.seen[prod] if key_time(key) >= since}
+        found = []
+        for prefix in prefixes:
+            for key in list_keys(bucket, prefix, refresh=True):
+                stamp = key_time(key)
+                if stamp is None or stamp < since or key in self.seen[prod]: continue
+                found.append((stamp, key))
+        return sorted(found)
+
+    def poll_mrms(self, now):
+        since = now - timedelta(minutes=2 * self.rings['mrms'].size)
+        days = sorted({stamp.strftime("%Y%m%d") for stamp in [since, now]})
+        new = self._new('mrms', "noaa-mrms-pds", [f"CONUS/{mrms_product}/{day}/" for day in days], since)
+        name = mrms_names[mrms_product]
+        for (stamp, key), path in zip(new, warm_frames("noaa-mrms-pds", [key for stamp, key in new], self.threads)):
+            ds = grib_dataset([read_grib(path, name)])
+            self.rings['mrms'].push(stamp, [remap(ds, grid) for grid in self.grids])
+            self.seen['mrms'].add(key)
+        return len(new)
+
+    def poll_goes(self, now):
+        since = now - timedelta(minutes=5 * self.rings['goes'].size)
+        hours = [floor_time(since, 60)]
+        while hours[-1] + timedelta(hours=1) <= now: hours.append(hours[-1] + timedelta(hours=1))
+        new = self._new('goes', "noaa-goes16", [f"ABI-L2-MCMIPC/{hour:%Y}/{hour.timetuple().tm_yday:03d}/{hour:%H}/" for hour in hours], since)
+        if not new: return 0
+        cubes = read_scans("noaa-goes16", [key for stamp, key in new], self.grids, threads=self.threads)
+        for k, (stamp, key) in enumerate(new):
+            self.rings['goes'].push(stamp, [cube[k] for cube in cubes])
+            self.seen['goes'].add(key)
+        return len(new)
+
+    def poll_hrrr(self, now):
+        # the analysis hours the newest cycle needs; one that has not been published yet is simply tried again next poll
+        hrtime = (now - timedelta(hours=1, minutes=self.delay[1])).replace(minute=0, second=0, microsecond=0)
+        found = 0
+        for date in [hrtime, hrtime + timedelta(hours=1)]:
+            if date in self.rings['hrrr']: continue
+            try: frame = hrrr_cycle(date, 0, hrrr_search)
+            except Exception as e:
+                count('stream_waits', product='hrrr', reason=reason(e).split(':')[0])
+                continue
+            ds = grib_dataset([frame])
+            self.rings['hrrr'].push(date, [remap(ds, grid) for grid in self.grids])
+            found += 1
+        return found
+
+    def poll(self, now):
+        found = {'mrms': self.poll_mrms(now), 'goes': self.poll_goes(now), 'hrrr': self.poll_hrrr(now)}
+        for prod, new in found.items(): count('stream_frames', new, product=prod)
+        return found
+
+    def inputs(self, cycle):
+        # same arrays goes(), hrrr() and merge_ins() give for a sample at cycle, or None while a product is still missing
+        cutoff = cycle - timedelta(minutes=self.delay[2]) + timedelta(minutes=1)
+        scans = self.rings['goes'].between(cycle - timedelta(hours=3), cutoff)[-13:]
+        if len(scans) < 13 or scans[-1][0] < cutoff - timedelta(minutes=6): return None
+        hrtime = (cycle - timedelta(hours=1, minutes=self.delay[1])).replace(minute=0, second=0, microsecond=0)
+        cycles = [hrtime, hrtime + timedelta(hours=1)]
+        if any(date not in self.rings['hrrr'] for date in cycles): return None
+        out = {}
+        for g, (name, grid) in enumerate(self.samples):
+            goes = goes_steps(grid, np.stack([frame[g] for stamp, frame in scans]), cycle)
+            hrrr = hrrr_steps(xr.concat([self.rings['hrrr'].frames[date][g] for date in cycles], dim='time'), hrtime, cycle)
+            out[name] = xr.merge([goes, hrrr, elev_time(cycle, grid)])
+        return out
+
+    def mrms(self, cycle):
+        # the verifying radar for cycle: its 31 frames arrive over the hour after it, so this lags the inputs by an hour
+        start = floor_time(cycle - timedelta(minutes=self.delay[0]), 2) + timedelta(minutes=2)
+        frames = self.rings['mrms'].between(start, start + timedelta(hours=3))[:31]
+        if len(frames) < 31: return None
+        out = {}
+        for g, (name, grid) in enumerate(self.samples):
+            ds = xr.concat([frame[g] for stamp, frame in frames], dim='time')
+            out[name] = mrms_steps(ds, cycle + timedelta(minutes=5))
+        return out
+
+
+__all__ = ['ring_sizes', 'floor_time', 'Ring', 'Stream']
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import xarray as xr
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import convolve
+from . import datdir
+
+refvar = 'ReflectivityM10C_500mabovemeansealevel'
+capevar = 'CAPE_255M0mbaboveground'
+cinvar = 'CIN_255M0mbaboveground'
+
+
+def _counts(ref, cape, cin, rthr, cthr, nthr):
+    env = (cape >= cthr) & (cin >= nthr)
+    count = ((ref >= rthr) & env[..., None, :, :]).sum(axis=-3, dtype=np.int16)
+    kernel = np.ones((1, ) * (count.ndim - 2) + (3, 3), dtype=np.int16)
+    return count, convolve(count, kernel, mode='constant', cval=0)
+
+
+def target_mask(ref, cape, cin, rthr, cthr, nthr, tch):
+    # ref is (..., time, lat, lon), cape and cin are the last input step (..., lat, lon); any leading dims are samples
+    count, touching = _counts(ref, cape, cin, rthr, cthr, nthr)
+    return (count >= 1) & (touching >= tch + 1)
+
+
+def combo_name(combo):
+    return "target_" + "_".join(str(value) for value in combo).replace('-', 'm')
+
+
+def sweep_masks(ref, cape, cin, combos):
+    # combinations differing only in touch share one count and one convolution
+    counts = {}
+    masks = {}
+    for rthr, cthr, nthr, tch in combos:
+        if (rthr, cthr, nthr) not in counts: counts[(rthr, cthr, nthr)] = _counts(ref, cape, cin, rthr, cthr, nthr)
+        count, touching = counts[(rthr, cthr, nthr)]
+        masks[(rthr, cthr, nthr, tch)] = (count >= 1) & (touching >= tch + 1)
+    return masks
+
+
+def sample_fields(dirname):
+    # only the three arrays the rule needs are read
+    with xr.open_zarr(f"../{datdir}/{dirname}/mrms.zarr") as mrms, xr.open_zarr(f"../{datdir}/{dirname}/inputs.zarr") as ins:
+        fields = (mrms[refvar].values, ins[capevar].isel(time=12).values, ins[cinvar].isel(time=12).values)
+        coords = {'time': mrms['time'].values[0], 'lat': mrms['lat'].values, 'lon': mrms['lon'].values}
+    return fields, coords
+
+
+def target_dataset(mask, coords):
+    return xr.Dataset({'target': (('lat', 'lon'), mask.astype(np.int8))}, coords=coords)
+
+
+def sample_target(dirname, ref, cape, cin, tch):
+    (rf, cp, cn), coords = sample_fields(dirname)
+    return target_dataset(target_mask(rf, cp, cn, ref, cape, cin, tch), coords)
+
+
+def batch_sweep(dirnames, combos, threads=8):
+    # loads a batch of samples on a thread pool, then runs every combination over the stacked arrays
+    with ThreadPoolExecutor(max_workers=threads) as pool: loaded = list(pool.map(sample_fields, dirnames))
+    rf, cp, cn = (np.stack([fields[k] for fields, coords in loaded]) for k in range(3))
+    masks = sweep_masks(rf, cp, cn, combos)
+    out = {}
+    for k, (dirname, (fields, coords)) in enumerate(zip(dirnames, loaded)):
+        out[dirname] = xr.Dataset({combo_name(combo): (('lat', 'lon'), masks[combo][k].astype(np.int8)) for combo in combos}, coords=coords)
+    return out
+
+
+def batch_targets(dirnames, ref, cape, cin, tch, threads=8):
+    combo = (ref, cape, cin, tch)
+    return {dirname: ds.rename({combo_name(combo): 'target'}) for dirname, ds in batch_sweep(dirnames, [combo], threads).items()}
+
+
+def store_sweep(ds, combos, batch=64):
+    # same rules over a consolidated store, a block of samples at a time
+    masks = {combo: [] for combo in combos}
+    for start in range(0, ds.sizes['sample'], batch):
+        block = ds.isel(sample=slice(start, start + batch))
+        found = sweep_masks(block[refvar].values, block[capevar].isel(step=12).values, block[cinvar].isel(step=12).values, combos)
+        for combo in combos: masks[combo].append(found[combo])
+    data = {combo_name(combo): (('sample', 'y', 'x'), np.concatenate(masks[combo]).astype(np.int8)) for combo in combos}
+    return xr.Dataset(data, coords={'sample': ds['sample'].values})
+
+
+__all__ = ['refvar', 'capevar', 'cinvar', 'target_mask', 'combo_name', 'sweep_masks', 'sample_fields', 'target_dataset', 'sample_target', 'batch_sweep', 'batch_targets', 'store_sweep']
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+# every product is resampled onto the same hour of 5-minute steps
+steps = 13
+step_freq = '5min'
+
+
+def time_axis(start, periods=steps, freq=step_freq):
+    return pd.date_range(start, periods=periods, freq=freq)
+
+
+def mask_range(data, lo, hi, fill):
+    # cdo setrtomiss,lo,hi followed by setmisstoc,fill: values in [lo, hi] and missing values both become fill
+    data = np.asarray(data)
+    return np.where(np.isnan(data) | ((data >= lo) & (data <= hi)), fill, data).astype(data.dtype)
+
+
+def interp_time(data, src, dst):
+    # cdo inttime on a (time, ...) stack: linear in time between the two bracketing frames, missing if either is
+    src = np.asarray(src, dtype='datetime64[ns]').astype(np.int64)
+    dst = np.asarray(dst, dtype='datetime64[ns]').astype(np.int64)
+    if dst.min() < src[0] or dst.max() > src[-1]: raise ValueError("target times fall outside the source frames")
+    out = np.empty((len(dst), ) + data.shape[1:], dtype=data.dtype)
+    for k, t in enumerate(dst):
+        i = min(np.searchsorted(src, t, side='right') - 1, len(src) - 2)
+        w = (t - src[i]) / (src[i+1] - src[i])
+        if w == 0: out[k] = data[i]
+        elif w == 1: out[k] = data[i+1]
+        else: out[k] = data[i] * (1 - w) + data[i+1] * w
+    return out
+
+
+def resample(ds, times, relabel=None):
+    # relabel is cdo settaxis: the frames are renamed start, start+freq, ... before interpolating onto times
+    src = ds['time'].values if relabel is None else time_axis(relabel[0], ds.sizes['time'], relabel[1])
+    out = ds.drop_vars([name for name, var in ds.variables.items() if 'time' in var.dims]).assign_coords(time=('time', times))
+    for name, var in ds.data_vars.items():
+        if 'time' not in var.dims: continue
+        data = interp_time(np.moveaxis(var.values, var.dims.index('time'), 0), src, times)
+        out[name] = (var.dims, np.moveaxis(data, 0, var.dims.index('time')), var.attrs)
+    return out
+
+
+def hold_time(ds, times):
+    # a static field repeated on every step of the axis
+    if 'time' in ds.dims: ds = ds.isel(time=0, drop=True)
+    elif 'time' in ds.coords: ds = ds.drop_vars('time')
+    return ds.expand_dims(time=times)
+
+
+def chunk_encoding(ds, chunks):
+    # zarr chunking for in-memory arrays, in place of dask chunks on an opened file
+    return {name: {'chunks': tuple(min(chunks.get(dim, size), size) for dim, size in zip(var.dims, var.shape))} for name, var in ds.data_vars.items()}
+
+
+__all__ = ['steps', 'step_freq', 'time_axis', 'mask_range', 'interp_time', 'resample', 'hold_time', 'chunk_encoding']